@@ -13,11 +13,15 @@ Library imports and initialization
 '''
 
 # standard libraries
+import itertools
+import multiprocessing
 import operator as op
+from collections import OrderedDict
 
 # nonstandard libraries
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy.special import gammaln, xlogy, xlog1py
 
 '''
 Main function execution (if file not imported, this will run)
@@ -30,6 +34,8 @@ def main():
     mcs.build_repertoire()
     fs,results = mcs.start_test()
     #fs,var,results = mcs.start_mass_test()
+    #mcs.grid_linspace('alpha',0.5,2.0,16); mcs.grid_logspace('w',1,3,16)
+    #sweep = mcs.start_sweep(n_jobs=4)
 
     visualize_1D(fs,results)
     #visualize_2D([np.log10(f) for f in fs],var,results)
@@ -64,6 +70,120 @@ def binomial_list(w,f):
 def perm_match(w,f,i):
     return (f**i)*((1-f)**(w-i))
 
+# log binomial pmf for w trials, as a (len(fs) x w+1) array over all frequencies fs
+def log_binomial_pmf(w,fs):
+    fs,i = np.asarray(fs,dtype=float)[:,None],np.arange(w+1)
+    log_ncr = gammaln(w+1) - gammaln(i+1) - gammaln(w-i+1)
+    return log_ncr + xlogy(i,fs) + xlog1py(w-i,-fs)
+
+# probability that a permutation of i choose w elements is met by at least one clone (frequencies fs), for i in 0..w
+# evaluated as 1 - exp(sum(log1p(-perm_match))); log(perm_match) is linear in i, so each clone only needs the
+# band of i where perm_match does not underflow, which keeps this near linear in the number of clones
+def repertoire_perm_match(w,fs,chunk_size=2**22):
+    fs = np.asarray(fs,dtype=float)
+    log_tiny = np.log(np.finfo(float).tiny*np.finfo(float).eps) # perm_match below exp(log_tiny) is 0.0
+    log_first,log_last = xlog1py(w,-fs),xlogy(w,fs) # log(perm_match) at i = 0 and i = w
+    log_sum = np.zeros(w+1)
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        cross = w*(log_tiny - log_first)/(log_last - log_first) # i where log(perm_match) crosses log_tiny
+
+    # clones with perm_match decreasing in i contribute over i in 0..hi, the others over i in lo..w
+    decreasing = log_first >= log_last
+    hi = np.where(log_last > log_tiny, w, np.where(log_first <= log_tiny, -1, np.floor(np.nan_to_num(cross)) + 1))
+    lo = np.where(log_first > log_tiny, 0, np.where(log_last <= log_tiny, w+1, np.ceil(np.nan_to_num(cross)) - 1))
+    lo[np.isneginf(log_first) & ~decreasing] = w
+
+    for group,bound,is_decreasing in [(decreasing,hi,True),(~decreasing,lo,False)]:
+        group_fs,group_bound = fs[group],(np.clip(bound[group],-1,w) if is_decreasing else np.clip(bound[group],0,w+1)).astype(int)
+        order = np.argsort(group_bound)[::-1] if is_decreasing else np.argsort(group_bound)
+        group_fs,group_bound = group_fs[order],group_bound[order]
+        start = 0
+        while start < len(group_fs):
+            # chunks of clones with similar bands, bounded in total size
+            b = group_bound[start]
+            width = b+1 if is_decreasing else w+1-b
+            if width <= 0: break
+            stop = min(len(group_fs),start + max(1,chunk_size//width))
+            i = np.arange(0,b+1) if is_decreasing else np.arange(b,w+1)
+            log_match = xlogy(i,group_fs[start:stop,None]) + xlog1py(w-i,-group_fs[start:stop,None])
+            with np.errstate(divide='ignore'):
+                log_sum[i] += np.log1p(-np.exp(log_match)).sum(axis=0)
+            start = stop
+
+    return -np.expm1(log_sum)
+
+# probability that a clone of frequency f is present among n cells
+def present_frequency(f,n):
+    with np.errstate(divide='ignore'):
+        return -np.expm1(n*np.log1p(-np.asarray(f,dtype=float)))
+
+# probability of convoluted signals for clones with (present) frequencies fs_present, given the repertoire's present frequencies
+def failure_rates(w,p_present,fs_present):
+    match = repertoire_perm_match(w,p_present) # p_present modification
+    return np.exp(log_binomial_pmf(w,fs_present)).dot(match)
+
+# normalized power law repertoire of count clones, keeping the last few built (per process)
+# the returned array is shared through the cache, so it is read-only; copy it before modifying
+_repertoire_cache = OrderedDict()
+_REPERTOIRE_CACHE_SIZE = 8
+def build_repertoire(alpha,count):
+    key = (float(alpha),int(count))
+    if key in _repertoire_cache:
+        _repertoire_cache[key] = _repertoire_cache.pop(key)
+    else:
+        p = np.arange(1,key[1]+1,dtype=float)**-key[0]
+        p /= p.sum()
+        p.flags.writeable = False
+        _repertoire_cache[key] = p
+        while len(_repertoire_cache) > _REPERTOIRE_CACHE_SIZE:
+            _repertoire_cache.popitem(last=False)
+    return _repertoire_cache[key]
+
+# variables that can be swept, and their types
+_SWEEP_TYPES = {'w': int,'n': int,'alpha': float,'count': int}
+
+# failure rates at a single sweep point; a pure function of its arguments, so it can run in any process
+def _sweep_point(args):
+    index,params,fs = args
+    p = build_repertoire(params['alpha'],params['count'])
+    return index,failure_rates(params['w'],present_frequency(p,params['n']),present_frequency(fs,params['n']))
+
+
+'''
+Class: Labeled array
+Function: Array of sweep results with named axes and their coordinate values
+'''
+
+class Labeled_Array:
+    def __init__(self,data,dims,coords):
+        self.data = data
+        self.dims = tuple(dims)
+        self.coords = OrderedDict((d,np.asarray(coords[d])) for d in self.dims)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __getitem__(self,key):
+        return self.data[key]
+
+    # selects by coordinate value (nearest) along the named axes, e.g. sel(alpha=1.0,w=96)
+    def sel(self,**values):
+        index,dims = [],[]
+        for d in self.dims:
+            if d in values:
+                index.append(int(np.argmin(np.abs(self.coords[d] - values[d]))))
+            else:
+                index.append(slice(None))
+                dims.append(d)
+        data = self.data[tuple(index)]
+        if len(dims) == 0: return data
+        return Labeled_Array(data,dims,self.coords)
+
+    def __repr__(self):
+        return 'Labeled_Array(dims={}, shape={})'.format(self.dims,self.shape)
+
 
 '''
 Class: Multicell Sequencing Analysis
@@ -75,11 +195,11 @@ class Multicell_Sequencing:
         self.w,self.n = w,n
         self.alpha,self.count = float(alpha),int(count)
         self.p,self.fs = None,None
-        self.var = None
+        self.var_name,self.var = None,None
+        self.grid = OrderedDict()
     
     def build_repertoire(self):
-        p = [(o+1)**-self.alpha for o in xrange(self.count)]
-        self.p = [i/sum(p) for i in p]
+        self.p = build_repertoire(self.alpha,self.count).copy()
 
     def fs_linspace(self,start,stop,num=5):
         self.fs = np.linspace(start,stop,num)
@@ -95,30 +215,67 @@ class Multicell_Sequencing:
         self.var_name = var_name
         self.var = np.linspace(start,stop,num)
 
-    def start_mass_test(self,silent=True):
+    # grid axes for start_sweep(); each call adds (or replaces) one variable of the grid
+    def grid_values(self,var_name,values):
+        if var_name not in _SWEEP_TYPES:
+            raise ValueError('Unknown sweep variable {}'.format(var_name))
+        self.grid[var_name] = np.asarray(values)
+
+    def grid_logspace(self,var_name,start,stop,num=5):
+        self.grid_values(var_name,np.logspace(start,stop,num))
+
+    def grid_linspace(self,var_name,start,stop,num=5):
+        self.grid_values(var_name,np.linspace(start,stop,num))
+
+    def start_mass_test(self,silent=True,n_jobs=1):
         if self.var_name is None:
             print 'No variable defined for sensitivity!'
             return None 
 
-        results = []
-        
-        # start iteration over variable for sensitivity
-        for v in self.var: 
-            print 'Starting variable {} for value {}'.format(self.var_name,v)
-            if self.var_name == 'w': 
-                self.w = int(v)
-            elif self.var_name == 'n':
-                self.n = int(v)
-            elif self.var_name == 'alpha':
-                self.alpha = float(v) 
-            elif self.var_name == 'count':
-                self.count = int(v)
-
-            self.build_repertoire()
-            fs,res = self.start_test()
-            results.append(res)
-
-        return self.fs,self.var,results
+        sweep = self.start_sweep(OrderedDict([(self.var_name,self.var)]),silent=silent,n_jobs=n_jobs)
+        return self.fs,self.var,sweep.data.tolist()
+
+    def start_sweep(self,grid=None,silent=True,n_jobs=1):
+        # evaluates start_test() over every point of the grid (an OrderedDict of variable -> values, self.grid by default),
+        # with the object's current w/n/alpha/count for variables not in the grid. The object itself is not modified.
+        # Returns a Labeled_Array with one axis per grid variable, followed by the clone frequency axis 'f'
+        grid = self.grid if grid is None else OrderedDict(grid)
+        if self.fs is None:
+            print 'Clone frequencies not defined!'
+            return None
+        for var_name in grid:
+            if var_name not in _SWEEP_TYPES:
+                raise ValueError('Unknown sweep variable {}'.format(var_name))
+        # grid values as evaluated (e.g. w is truncated to an int), which also label the results
+        grid = OrderedDict((d,np.array([_SWEEP_TYPES[d](v) for v in values])) for d,values in grid.items())
+
+        # sweep points, ordered so that points sharing a repertoire are evaluated together
+        base = {'w': self.w,'n': self.n,'alpha': self.alpha,'count': self.count}
+        points = []
+        for index in itertools.product(*[range(len(v)) for v in grid.values()]):
+            params = dict(base)
+            params.update((d,_SWEEP_TYPES[d](grid[d][i])) for d,i in zip(grid,index))
+            points.append((index,params,self.fs))
+        points.sort(key=lambda point: (point[1]['alpha'],point[1]['count']))
+
+        if n_jobs > 1:
+            pool = multiprocessing.Pool(n_jobs)
+            res = pool.imap_unordered(_sweep_point,points,chunksize=max(1,len(points)//(4*n_jobs)))
+        else:
+            pool,res = None,itertools.imap(_sweep_point,points)
+
+        results = np.zeros([len(v) for v in grid.values()] + [len(self.fs)])
+        for index,rates in res:
+            results[index] = rates
+            if not silent: print 'Finished point {}'.format(', '.join('{} = {}'.format(d,grid[d][i]) for d,i in zip(grid,index)))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        coords = OrderedDict(grid)
+        coords['f'] = self.fs
+        return Labeled_Array(results,coords.keys(),coords)
 
     def start_test(self,silent=True):
         # check to make sure important sets are define
@@ -129,20 +286,16 @@ class Multicell_Sequencing:
             print 'Clone frequencies not defined!'
             return None 
 
-        self.p_present = [1 - (1-i)**self.n for i in self.p]
-        self.fs_present = [1 - (1-i)**self.n for i in self.fs]
-
-        # prep for simulation
-        results = []
-        repertoire_perm_match = [(1 - reduce(op.mul,[1 - perm_match(self.w,f1,i) for f1 in self.p_present],1)) for i in xrange(0,self.w+1)] # p_present modification
+        self.p_present = present_frequency(self.p,self.n)
+        self.fs_present = present_frequency(self.fs,self.n)
 
-        # main simulation loop
-        for f,f_orig in zip(self.fs_present,self.fs):
-            binomial = binomial_list(self.w,f)
-            results.append(sum([a*b for a,b in zip(binomial,repertoire_perm_match)]))
-            if not silent: print 'Added clone with frequency {}%: Failure rate of {}%'.format(round(100*f_orig,4),round(100*results[-1],4))     
+        # main simulation, over all clone frequencies at once
+        results = failure_rates(self.w,self.p_present,self.fs_present).tolist()
+        if not silent:
+            for f_orig,res in zip(self.fs,results):
+                print 'Added clone with frequency {}%: Failure rate of {}%'.format(round(100*f_orig,4),round(100*res,4))
 
-        return self.fs,results 
+        return self.fs,results
 
 '''
 Visualization methods (maybe put this into a class eventually
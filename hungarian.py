@@ -1,160 +1,278 @@
 # Implement Hungarian algorithm
 
+import heapq
+
+import numpy as np
+import scipy.sparse
+
 def solve_simple_assignment(quals, initial = None):
-  def compute_initial():
-    # Find an initial assignment by simply using the first unassigned job in each row
-    assignment = [[False for elem in row] for row in quals]
-    assigned_cols = [False] * len(quals[0])
-    for a_row, q_row in zip(assignment,quals):
-      for i, q_elem in enumerate(q_row):
-        if q_elem == True and not assigned_cols[i]:
-          a_row[i] = True
-          assigned_cols[i] = True
-          break
-    return assignment
-
-  def enumerate_transfers(assignment):
-    # Determine subset of all transfers using BFS (NOT the DFS proposed in the Kuhn 1955)
-    # Each row is only used in at most one transfer
-    # When an improving transfer is found, the function returns prematurely
-
-    improving_transfers = []
-    nonimproving_transfers = []
-    incomplete_transfers = []
-
-    used_rows = [False]*len(assignment)
-    
-    # Find transfer starting locations
-    for j in xrange(len(quals[0])):
-      if all([not assignment[i][j] for i in xrange(len(quals))]):
-        qual_rows = [i for i in range(len(quals)) if quals[i][j]]
-        incomplete_transfers.extend([[(i,j)] for i in qual_rows])
-
-    # Continue incomplete transfers until none are left
-    while len(incomplete_transfers) > 0:
-      new_incomplete_transfers = []
-      for transfer in incomplete_transfers:
-        # Search the last row in the transfer for an assigned column
-        # If none, this row can be assigned to this column, so the transfer is complete (and an improvement)
-        # If an assigned column is found, extend the transfer accordingly
-        i,j = transfer[-1]
-        if all([not a for a in assignment[i]]):
-          improving_transfers.append(transfer)
-          return improving_transfers, nonimproving_transfers
-          #continue
-        new_j = [new_j for new_j,a in enumerate(assignment[i]) if a][0]
-        transfer.append((i,new_j))
-
-        # Search this new column (new_j) for an unassigned row.
-        # If none, the transfer is complete (but NOT an improvement)
-        # For each unassigned row found, a new transfer to be extended is added to the growing list
-        new_rows = [new_i for new_i in range(len(quals)) if quals[new_i][new_j] and not used_rows[new_i]]
-        if len(new_rows) == 0:
-          nonimproving_transfers.append(transfer)
-        else:
-          for new_i in new_rows:
-            new_incomplete_transfers.append(transfer+[(new_i,new_j)])
-            used_rows[new_i] = True
-      incomplete_transfers = new_incomplete_transfers
-
-    return (improving_transfers, nonimproving_transfers)
+  # Maximum assignment for a boolean qualification matrix (quals[i][j] is True if row i may take column j).
+  # Returns a tuple: (the optimal assignment, essential rows, essential columns)
+  quals = np.asarray(quals, dtype=bool)
+  num_rows, num_cols = quals.shape
+  row_match = -np.ones(num_rows, dtype=np.int64)
+  col_match = -np.ones(num_cols, dtype=np.int64)
 
   # Determine initial assignments
   if initial is not None:
-    assignment = initial
+    rows, cols = np.nonzero(np.asarray(initial, dtype=bool))
+    row_match[rows], col_match[cols] = cols, rows
   else:
-    assignment = compute_initial()
+    # Find an initial assignment by simply using the first unassigned job in each row
+    for i in xrange(num_rows):
+      free_cols = np.flatnonzero(quals[i] & (col_match==-1))
+      if len(free_cols) > 0:
+        row_match[i], col_match[free_cols[0]] = free_cols[0], i
 
-  # Keep searching for improving transfers (i.e. transfers w/ odd # entries),
-  # improving the assignment each time one is found.
-  improving_transfers, nonimproving_transfers = enumerate_transfers(assignment)
-  while len(improving_transfers) > 0:
-    transfer = improving_transfers[0]
-    for i,j in transfer:
-      assignment[i][j] = not assignment[i][j]
+  def search_transfers(start_cols):
+    # BFS over transfers (alternating paths) starting from the given unassigned columns.
+    # Returns the path to the first unassigned row found, and the rows reached by the search
+    # Each row is only used in at most one transfer
+    reached_rows = np.zeros(num_rows, dtype=bool)
+    prev_col = -np.ones(num_rows, dtype=np.int64)
+    frontier = list(start_cols)
+    while len(frontier) > 0:
+      new_frontier = []
+      for j in frontier:
+        new_rows = np.flatnonzero(quals[:,j] & ~reached_rows)
+        reached_rows[new_rows] = True
+        prev_col[new_rows] = j
+        free_rows = new_rows[row_match[new_rows]==-1]
+        if len(free_rows) > 0:
+          # Improving transfer: walk back to the starting column
+          path, i = [], free_rows[0]
+          while i != -1:
+            path.append((i, prev_col[i]))
+            i = col_match[prev_col[i]]
+          return path, reached_rows
+        new_frontier.extend(row_match[new_rows].tolist())
+      frontier = new_frontier
+    return None, reached_rows
 
-    improving_transfers, nonimproving_transfers = enumerate_transfers(assignment)
+  # Keep searching for improving transfers, improving the assignment each time one is found.
+  # A column that fails to reach an unassigned row can not be assigned later on, so each column is searched once
+  for j in np.flatnonzero(col_match==-1):
+    path, _ = search_transfers([j])
+    if path is None:  continue
+    for i,j in path:
+      row_match[i], col_match[j] = j, i
 
   # When none are found, mark essential rows (those found in at least one transfer)
   # and essential columns (columns assigned to nonessential rows)
-  # and return a tuple: (the optimal assignment, essential rows, essential columns)
-  essential_rows = [False] * len(quals)
-  for t in nonimproving_transfers:
-    for i,j in t:  essential_rows[i] = True
-
-  essential_cols = [False] * len(quals[0])
-  for i, row in enumerate(assignment):
-    if essential_rows[i]:  continue
-    for j, v in enumerate(row):
-      if v:  essential_cols[j] = True
-  
-  return (assignment, essential_rows, essential_cols)
-
-def solve_general_assignment(ratings):
-  def compute_initial(ratings):
-    a = [max(row) for row in ratings]
-    b = [max([ratings[i][j] for i in range(len(ratings))]) for j in range(len(ratings[0]))]
-
-    if sum(a) <= sum(b):
-      return a, [0]*len(b)
-    else:
-      return [0]*len(a), b
-
-  def solve_corresponding_simple_assignment(ratings, u, v, init_assignment=None):
-    # Compute the qualification matrix for the corresponding simple assignment problem,
-    # given the budgets assigned to rows (u) and columns (v)
-    quals = []
-    for i, row in enumerate(ratings):
-      q_row = []
-      for j, r_ij in enumerate(row):
-        q_row.append(u[i]+v[j]==r_ij)
-      quals.append(q_row)
-
-    # Solve simple assignment problem corresponding to this qualification matrix
-    return solve_simple_assignment(quals, initial=init_assignment)
-
-  def check_optimal_solution(ratings, assignment, u, v):
-    assigned_rows = sum([any(row) for row in assignment])
-    return assigned_rows==len(ratings)
-
-  # Make ratings a square matrix
-  matrix_dim = max(len(ratings), len(ratings[0]))
-  add_rows = matrix_dim - len(ratings)
-  add_cols = matrix_dim - len(ratings[0])
-  ratings_aug = [row + [0]*add_cols for row in ratings] + [[0]*matrix_dim]*add_rows
-
-  # Compute initial budget
-  u,v = compute_initial(ratings_aug)
-
-  # Solve simple assignment problem until this solution solves the general assignment problem
-  assignment_aug, essential_rows, essential_cols = solve_corresponding_simple_assignment(ratings_aug, u,v)
-  old_budget_tot = float('inf')
-  budget_tot = sum(u) + sum(v)
-  while not check_optimal_solution(ratings_aug, assignment_aug, u, v):
-    d = min([u[i]+v[j]-ratings_aug[i][j] for i in range(len(essential_rows)) if not essential_rows[i] for j in range(len(essential_cols)) if not essential_cols[j]])
-    min_u = min([u[i] for i in range(len(essential_rows)) if not essential_rows[i]])
-    min_v = min([v[j] for j in range(len(essential_cols)) if not essential_cols[j]])
-    if min_u > 0:
-      m = min(min_u, d)
-      for i in range(len(essential_rows)):
-        if not essential_rows[i]:  u[i] -= m
-      for j in range(len(essential_cols)):
-        if essential_cols[j]:  v[j] += m
-    else:
-      m = min(min_v, d)
-      for i in range(len(essential_rows)):
-        if essential_rows[i]:  u[i] += m
-      for j in range(len(essential_cols)):
-        if not essential_cols[j]:  v[j] -= m
-
-    assignment_aug, essential_rows, essential_cols = solve_corresponding_simple_assignment(ratings_aug, u,v, assignment_aug)
-
-    old_budget_tot = budget_tot
-    budget_tot = sum(u) + sum(v)
-
-  # Remove extra rows from assignment matrix
-  assignment = [[assignment_aug[i][j] for j in range(len(ratings[0]))] for i in range(len(ratings))]
-  #print "Hungarian algorithm complete: sum(weights) = {0}; sum(budget) = {1}".format(sum([ratings[i][j] for i in range(len(assignment)) for j in range(len(assignment[i])) if assignment[i][j]]), sum(u)+sum(v))
-
-  return assignment
-          
+  _, essential_rows = search_transfers(np.flatnonzero(col_match==-1))
+  essential_cols = np.zeros(num_cols, dtype=bool)
+  essential_cols[row_match[(row_match!=-1) & ~essential_rows]] = True
+
+  assignment = np.zeros((num_rows, num_cols), dtype=bool)
+  assigned = np.flatnonzero(row_match!=-1)
+  assignment[assigned, row_match[assigned]] = True
+
+  return (assignment.tolist(), essential_rows.tolist(), essential_cols.tolist())
+
+def _augment_rows(costs, rows, u, v, row_match, col_match):
+  # Assigns each of the given (unassigned) rows by a shortest augmenting path on the reduced costs
+  # costs[i,j] - u[i] - v[j] (Dijkstra over columns, as in the O(n^3) form of the Hungarian algorithm).
+  # The budgets u,v and the matching are updated in place; returns the number of search steps taken
+  num_cols = costs.shape[1]
+  steps = 0
+  for i in rows:
+    min_slack = np.full(num_cols, np.inf)
+    prev_col = -np.ones(num_cols, dtype=np.int64) # column through which each column was reached (-1 for row i)
+    used_cols = np.zeros(num_cols, dtype=bool)
+    tree_rows = [i]
+
+    cur_row, cur_col = i, -1
+    while True:
+      steps += 1
+      # Relax the slack of all columns outside the tree from the newest row in the tree
+      slack = costs[cur_row] - u[cur_row] - v
+      better = (slack < min_slack) & ~used_cols
+      min_slack[better] = slack[better]
+      prev_col[better] = cur_col
+
+      # Add the tightest column to the tree, shifting the budgets so its edge becomes tight
+      next_col = np.argmin(np.where(used_cols, np.inf, min_slack))
+      delta = min_slack[next_col]
+      if delta == np.inf:
+        raise ValueError("No feasible assignment exists for row {0}".format(i))
+      u[tree_rows] += delta
+      v[used_cols] -= delta
+      min_slack -= delta
+      used_cols[next_col] = True
+      cur_col = next_col
+
+      # Stop at the first unassigned column; otherwise continue from the row it is assigned to
+      if col_match[cur_col] == -1:  break
+      cur_row = col_match[cur_col]
+      tree_rows.append(cur_row)
+
+    # Flip the assignments along the augmenting path
+    while cur_col != -1:
+      j_prev = prev_col[cur_col]
+      row = i if j_prev == -1 else col_match[j_prev]
+      col_match[cur_col], row_match[row] = row, cur_col
+      cur_col = j_prev
+
+  return steps
+
+def _solve_dense(ratings, initial = None):
+  # Maximum-weight assignment of the smaller dimension of ratings, optionally warm-started from
+  # initial = (assignment, row budgets, column budgets) of an earlier solve of a similar problem.
+  # Returns the matched (row, col) index arrays, the row and column budgets (u[i] + v[j] >= ratings[i][j],
+  # with equality on the assignment) and the number of augmenting path search steps taken
+  ratings = np.asarray(ratings, dtype=np.float64)
+  transposed = ratings.shape[0] > ratings.shape[1]
+  costs = -(ratings.T if transposed else ratings)
+  num_rows, num_cols = costs.shape
+
+  def assign_best_cols(v, row_match, col_match):
+    # Initial budget: each row's best rating, with each unassigned row taking its best column if it is still free
+    reduced = costs - v
+    free_rows = np.flatnonzero(row_match==-1)
+    best_cols = reduced[free_rows].argmin(axis=1)
+    free_rows, best_cols = free_rows[col_match[best_cols]==-1], best_cols[col_match[best_cols]==-1]
+    cols, first = np.unique(best_cols, return_index=True)
+    row_match[free_rows[first]], col_match[cols] = cols, free_rows[first]
+    return reduced.min(axis=1)
+
+  v = np.zeros(num_cols)
+  row_match = -np.ones(num_rows, dtype=np.int64)
+  col_match = -np.ones(num_cols, dtype=np.int64)
+  u = assign_best_cols(v, row_match, col_match)
+
+  if initial is not None:
+    prior, row_budgets, col_budgets = initial
+    prior = np.asarray(prior, dtype=bool)
+    if prior.shape != ratings.shape:
+      raise ValueError("Initial assignment has shape {0}, expected {1}".format(prior.shape, ratings.shape))
+    if transposed:
+      prior, col_budgets = prior.T, row_budgets
+
+    # Keep the prior assignment and the budgets of its columns.
+    # Columns that may be left unassigned (if there are more columns than rows) need a budget of at least zero
+    warm_v = np.zeros(num_cols)
+    warm_row_match = -np.ones(num_rows, dtype=np.int64)
+    warm_col_match = -np.ones(num_cols, dtype=np.int64)
+    rows, cols = np.nonzero(prior)
+    warm_row_match[rows], warm_col_match[cols] = cols, rows
+    warm_v[cols] = -np.asarray(col_budgets, dtype=np.float64)[cols]
+    rectangular = num_rows < num_cols
+    if rectangular:
+      warm_v = np.minimum(warm_v, 0)
+
+    # Drop prior assignments that are no longer tight under the new ratings, until the rest are
+    while True:
+      warm_u = (costs - warm_v).min(axis=1)
+      rows = np.flatnonzero(warm_row_match!=-1)
+      cols = warm_row_match[rows]
+      loose = costs[rows, cols] - warm_v[cols] != warm_u[rows]
+      if not loose.any():  break
+      warm_row_match[rows[loose]], warm_col_match[cols[loose]] = -1, -1
+      if not rectangular:  break
+      warm_v[cols[loose]] = 0
+    warm_u = assign_best_cols(warm_v, warm_row_match, warm_col_match)
+
+    # The rows left unassigned are the expensive part of a solve. Those left by a warm start take longer paths
+    # through a nearly complete assignment, so it is only used if it leaves well under as many as a cold start
+    if 2*(warm_row_match==-1).sum() <= (row_match==-1).sum():
+      u, v, row_match, col_match = warm_u, warm_v, warm_row_match, warm_col_match
+
+  steps = _augment_rows(costs, np.flatnonzero(row_match==-1), u, v, row_match, col_match)
+
+  rows = np.arange(num_rows)
+  if transposed:
+    return row_match, rows, -v, -u, steps
+  return rows, row_match, -u, -v, steps
+
+def solve_general_assignment(ratings, initial = None, return_budgets = False):
+  # Assignment maximizing the sum of ratings; ratings may be rectangular (rows x cols, as nested lists or an array),
+  # in which case every row or every column (whichever are fewer) is assigned.
+  # Returns a rows x cols boolean assignment matrix (nested lists).
+  # With return_budgets, returns (assignment, row budgets, column budgets) instead; passing this tuple back as initial
+  # warm-starts the solve of a perturbed ratings matrix of the same shape from the earlier solution.
+  # A scipy.sparse ratings matrix is solved with solve_sparse_assignment() over its stored entries instead,
+  # and the assignment is returned as a boolean CSR matrix
+  if scipy.sparse.issparse(ratings):
+    if initial is not None or return_budgets:
+      raise ValueError("Warm starts are only supported for dense ratings")
+    ratings = ratings.tocoo()
+    rows, cols = solve_sparse_assignment(ratings.row, ratings.col, ratings.data, ratings.shape)
+    return scipy.sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=ratings.shape)
+
+  ratings = np.asarray(ratings, dtype=np.float64)
+  assignment = np.zeros(ratings.shape, dtype=bool)
+  if ratings.size > 0:
+    rows, cols, u, v, _ = _solve_dense(ratings, initial)
+    assignment[rows, cols] = True
+  else:
+    u, v = np.zeros(ratings.shape[0]), np.zeros(ratings.shape[1] if ratings.ndim==2 else 0)
+  #print "Hungarian algorithm complete: sum(weights) = {0}; sum(budget) = {1}".format(ratings[assignment].sum(), u.sum()+v.sum())
+
+  if return_budgets:
+    return assignment.tolist(), u.tolist(), v.tolist()
+  return assignment.tolist()
+
+def solve_sparse_assignment(rows, cols, ratings, shape = None):
+  # Assignment maximizing the sum of ratings over an edge list (rows[k], cols[k], ratings[k]) of candidate pairs;
+  # pairs not listed can not be assigned, and rows or columns may be left unassigned.
+  # For nonnegative ratings the total rating matches solve_general_assignment() on the dense matrix with zeros elsewhere.
+  # Returns the assigned (row, col) index arrays, ordered by row
+  mat = scipy.sparse.coo_matrix((np.asarray(ratings, dtype=np.float64), (rows, cols)), shape=shape).tocsr()
+  num_rows, num_cols = mat.shape
+
+  # Edges are stored as costs (negated ratings). Each row i also has a private column num_cols+i of cost 0,
+  # standing for row i being unassigned, so that every row can always be assigned
+  indptr, edge_cols, edge_costs = mat.indptr.tolist(), mat.indices.tolist(), (-mat.data).tolist()
+  def row_edges(i):
+    return zip(edge_cols[indptr[i]:indptr[i+1]], edge_costs[indptr[i]:indptr[i+1]]) + [(num_cols+i, 0.)]
+
+  # Initial budget: each row's best rating, with each row taking its best column if no earlier row did
+  u = [0.]*num_rows
+  v = [0.]*(num_cols+num_rows)
+  row_match = [-1]*num_rows
+  col_match = [-1]*(num_cols+num_rows)
+  for i in xrange(num_rows):
+    j, c = min(row_edges(i), key=lambda e: e[1])
+    u[i] = c
+    if col_match[j] == -1:
+      row_match[i], col_match[j] = j, i
+
+  # Assign each remaining row by a shortest augmenting path on the reduced costs c[i,j] - u[i] - v[j],
+  # with Dijkstra over a heap of column distances so that each search scales with the number of edges
+  for i in xrange(num_rows):
+    if row_match[i] != -1:  continue
+    dist, prev_row, done_cols = {}, {}, []
+    done = set()
+    heap = []
+    cur_row, cur_dist = i, 0.
+    while True:
+      for j,c in row_edges(cur_row):
+        d = cur_dist + c - u[cur_row] - v[j]
+        if j not in done and d < dist.get(j, float('inf')):
+          dist[j], prev_row[j] = d, cur_row
+          heapq.heappush(heap, (d, j))
+      d, j = heapq.heappop(heap)
+      while j in done or d > dist[j]:
+        d, j = heapq.heappop(heap)
+      done.add(j)
+      done_cols.append(j)
+      if col_match[j] == -1:  break
+      cur_row, cur_dist = col_match[j], d
+
+    # Shift the budgets of the search tree so that the path found is tight
+    sink_dist = d
+    u[i] += sink_dist
+    for j in done_cols:
+      if col_match[j] != -1:  u[col_match[j]] += sink_dist - dist[j]
+      v[j] -= sink_dist - dist[j]
+
+    # Flip the assignments along the augmenting path
+    while True:
+      row = prev_row[j]
+      j_prev = row_match[row]
+      col_match[j], row_match[row] = row, j
+      if row == i:  break
+      j = j_prev
+
+  assigned = [i for i in xrange(num_rows) if row_match[i] < num_cols]
+  return np.array(assigned, dtype=np.int64), np.array([row_match[i] for i in assigned], dtype=np.int64)
@@ -0,0 +1,101 @@
+import sys
+import time
+
+import numpy as np
+import scipy.optimize
+import scipy.sparse
+
+import hungarian
+
+## Benchmarks hungarian.solve_general_assignment against scipy.optimize.linear_sum_assignment
+## on random dense rating matrices
+## and the sparse mode against the dense solver on rectangular, mostly zero rating matrices,
+## and warm-started against cold solves over a sequence of perturbed rating matrices
+## Usage: python hungarian_benchmark.py [max_dim] [iters] [skip_scipy_above]
+
+def time_call(func, *args):
+  start = time.time()
+  res = func(*args)
+  return res, time.time()-start
+
+def run_benchmark(max_dim = 2000, iters = 1, skip_scipy_above = None):
+  dims = [d for d in [100, 250, 500, 1000, 2000, 4000] if d <= max_dim]
+  rand = np.random.RandomState(0)
+
+  print "Assignment benchmark: square rating matrices up to {0}x{0}, {1} iteration(s)".format(max_dim, iters)
+  for dim in dims:
+    t_ours, t_scipy = 0., 0.
+    run_scipy = skip_scipy_above is None or dim <= skip_scipy_above
+    for iter in range(iters):
+      ratings = rand.rand(dim, dim)
+
+      assignment, t = time_call(hungarian.solve_general_assignment, ratings)
+      t_ours += t
+      total = ratings[np.array(assignment)].sum()
+
+      if run_scipy:
+        (rows, cols), t = time_call(scipy.optimize.linear_sum_assignment, -ratings)
+        t_scipy += t
+        if abs(total - ratings[rows, cols].sum()) > 1e-6*dim:
+          print "  WARNING: assignment totals differ ({0} vs {1})".format(total, ratings[rows, cols].sum())
+
+    line = "  {0}x{0}: hungarian {1:.3f} s".format(dim, t_ours/iters)
+    if run_scipy:
+      line += ", scipy {0:.3f} s".format(t_scipy/iters)
+    print line
+
+def run_sparse_benchmark(max_dim = 2000, iters = 1, density = 0.01):
+  dims = [d for d in [100, 250, 500, 1000, 2000, 4000] if d <= max_dim]
+  rand = np.random.RandomState(0)
+
+  print "Sparse assignment benchmark: {0}x(2*{0}) rating matrices with density {1}, {2} iteration(s)".format(max_dim, density, iters)
+  for dim in dims:
+    t_dense, t_sparse = 0., 0.
+    for iter in range(iters):
+      ratings = scipy.sparse.random(dim, 2*dim, density=density, format='coo', random_state=rand)
+
+      (rows, cols), t = time_call(hungarian.solve_sparse_assignment, ratings.row, ratings.col, ratings.data, ratings.shape)
+      t_sparse += t
+      total = ratings.tocsr()[rows, cols].sum()
+
+      dense = ratings.toarray()
+      assignment, t = time_call(hungarian.solve_general_assignment, dense)
+      t_dense += t
+      if abs(total - dense[np.array(assignment)].sum()) > 1e-6*dim:
+        print "  WARNING: assignment totals differ ({0} vs {1})".format(total, dense[np.array(assignment)].sum())
+
+    print "  {0}x{1}: sparse {2:.3f} s, dense {3:.3f} s".format(dim, 2*dim, t_sparse/iters, t_dense/iters)
+
+def run_warm_start_benchmark(max_dim = 2000, iters = 1, num_solves = 10, noise = 0.01, perturbed = 0.01):
+  dims = [d for d in [100, 250, 500, 1000, 2000, 4000] if d <= max_dim]
+  rand = np.random.RandomState(0)
+
+  print "Warm start benchmark: {0} solves of rating matrices with {1:.0%} of entries perturbed (noise {2}) up to {3}x{3}, {4} iteration(s)".format(num_solves, perturbed, noise, max_dim, iters)
+  for dim in dims:
+    t_cold, t_warm, steps_cold, steps_warm = 0., 0., 0, 0
+    for iter in range(iters):
+      base = rand.rand(dim, dim)
+      initial = None
+      for solve in range(num_solves):
+        ratings = base + noise*rand.randn(dim, dim)*(rand.rand(dim, dim) < perturbed)
+
+        (_, _, _, _, steps), t = time_call(hungarian._solve_dense, ratings)
+        t_cold += t
+        steps_cold += steps
+
+        (rows, cols, u, v, steps), t = time_call(hungarian._solve_dense, ratings, initial)
+        t_warm += t
+        steps_warm += steps
+
+        assignment = np.zeros(ratings.shape, dtype=bool)
+        assignment[rows, cols] = True
+        initial = (assignment, u, v)
+
+    print "  {0}x{0}: cold {1:.3f} s ({2} steps), warm {3:.3f} s ({4} steps) per solve".format(dim,
+      t_cold/(iters*num_solves), steps_cold/(iters*num_solves), t_warm/(iters*num_solves), steps_warm/(iters*num_solves))
+
+if __name__ == '__main__':
+  args = [int(v) for v in sys.argv[1:]]
+  run_benchmark(*args)
+  run_sparse_benchmark(*args[:2])
+  run_warm_start_benchmark(*args[:2])
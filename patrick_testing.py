@@ -93,29 +93,18 @@ data.save_data('patrick_testing.txt')
 '''
 The Meat-and-Potatoes
 '''
-# get uniques
-a_uniques = list(set([a for well in data.well_data for a in well[0]]))
-b_uniques = list(set([b for well in data.well_data for b in well[1]]))
+# get uniques (from the shared occupancy index)
+occupancy = data.get_occupancy()
+a_uniques,b_uniques = occupancy.alphas,occupancy.betas
 
-well_count = len(data.well_data) # count of wells
-w_ab = np.zeros((len(a_uniques),len(b_uniques)))    
+well_count = occupancy.num_wells # count of wells
 
-f_a = [float(sum([1 for well in data.well_data if i in well[0]]))/well_count for i in a_uniques] 
-f_b = [float(sum([1 for well in data.well_data if i in well[1]]))/well_count for i in b_uniques] 
+f_a = [float(c)/well_count for c in occupancy.alpha_counts] 
+f_b = [float(c)/well_count for c in occupancy.beta_counts] 
 c_a,c_b = len(f_a),len(f_b) # count of uniques
-img_ab = None 
-
-for well in data.well_data:
-    a_ind = [a_uniques.index(i) for i in well[0]]
-    b_ind = [b_uniques.index(i) for i in well[1]]
-    a_v,b_v = np.zeros((len(a_uniques),1)),np.zeros((1,len(b_uniques))) 
-    np.put(a_v,a_ind,np.ones((len(a_ind))))
-    np.put(b_v,b_ind,np.ones((len(b_ind))))
-    if img_ab == None: img_ab = np.matmul(a_v,b_v)
-    else: img_ab = np.dstack((img_ab,np.matmul(a_v,b_v)))
-    #w_ab += np.matmul(a_v,b_v)
-    
-w_ab = np.sum(img_ab,axis=2)
+
+# co-occurrence counts, as a sparse product of the occupancy matrices
+w_ab = occupancy.cooccurrence().toarray()
 
 #p_ab = np.array([[binomial_prob(int(w_ab[i,j]),f_a[i]*f_b[j],well_count) for j in xrange(c_b)] for i in xrange(c_a)])
 p_ab = np.array([[normal_estimate(int(w_ab[i,j]),f_a[i]*f_b[j],well_count) for j in xrange(c_b)] for i in xrange(c_a)])
@@ -128,7 +117,7 @@ matches = []
 for i in xrange(c_a):
     for j in xrange(c_b):
         if p_ab[i,j] > 0.9999 and w_ab[i,j] > 0:
-            matches.append([(a_uniques[i],b_uniques[j]),p_ab[i,j],w_ab[i,j],img_ab[i,j,:]]) 
+            matches.append([(a_uniques[i],b_uniques[j]),p_ab[i,j],w_ab[i,j],occupancy.alpha_wells[i].multiply(occupancy.beta_wells[j]).toarray().ravel()]) 
             #print 'Index {},{}: {},{}'.format(i,j,a_uniques[i],b_uniques[j])
             #print w_ab[i,j],p_ab[i,j]
             #print f_a[i],f_b[j]
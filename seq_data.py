@@ -1,49 +1,421 @@
 import json
+import struct
+import zipfile
+
+import numpy as np
+import scipy.sparse
+
+class WellOccupancy(object):
+  """ Compressed occupancy matrices for a list of wells, shared by the solvers.
+  Built once from well_data (a list of [alpha_list, beta_list] per well), or with from_csr() from
+  concatenated per-well chain arrays (e.g. memory-mapped from a binary data file):
+    Chain labels and index maps
+      - alphas, betas [sorted lists of distinct chain ids observed]
+      - alpha_to_idx, beta_to_idx [dicts mapping chain id -> row index]
+    Chain x well matrices (CSR, int32, 1 where the chain occurs in the well)
+      - alpha_wells [num alphas x num wells]
+      - beta_wells [num betas x num wells]
+    Well x chain matrices (CSR transposes of the above, for per-well lookups)
+      - well_alphas, well_betas
+    Counts
+      - alpha_counts, beta_counts [number of wells each chain occurs in]
+      - well_alpha_counts, well_beta_counts [number of distinct chains in each well]
+    Well bitsets (built on first use by chain_bitsets())
+      - alpha_bits, beta_bits [num chains x ceil(num wells/8), uint8, np.packbits order]
+  """
+
+  def __init__(self, well_data):
+    self.num_wells = len(well_data)
+
+    self.alphas = sorted(set([a for alist,_ in well_data for a in alist]))
+    self.betas = sorted(set([b for _,blist in well_data for b in blist]))
+    self.alpha_to_idx = {a: i for i,a in enumerate(self.alphas)}
+    self.beta_to_idx = {b: i for i,b in enumerate(self.betas)}
+
+    self._set_matrices(
+      WellOccupancy._build_matrix([alist for alist,_ in well_data], self.alpha_to_idx),
+      WellOccupancy._build_matrix([blist for _,blist in well_data], self.beta_to_idx)
+    )
+
+  @classmethod
+  def from_csr(cls, alpha_indptr, alpha_chains, beta_indptr, beta_chains):
+    # Builds the index from (indptr, chains) arrays, where the chains of well i are chains[indptr[i]:indptr[i+1]],
+    # without going through per-well lists
+    occupancy = cls.__new__(cls)
+    occupancy.num_wells = len(alpha_indptr)-1
+
+    alpha_labels, alpha_idx = np.unique(np.asarray(alpha_chains), return_inverse=True)
+    beta_labels, beta_idx = np.unique(np.asarray(beta_chains), return_inverse=True)
+    occupancy.alphas, occupancy.betas = alpha_labels.tolist(), beta_labels.tolist()
+    occupancy.alpha_to_idx = {a: i for i,a in enumerate(occupancy.alphas)}
+    occupancy.beta_to_idx = {b: i for i,b in enumerate(occupancy.betas)}
+
+    occupancy._set_matrices(
+      WellOccupancy._csr_from_indices(alpha_indptr, alpha_idx, len(alpha_labels)),
+      WellOccupancy._csr_from_indices(beta_indptr, beta_idx, len(beta_labels))
+    )
+    return occupancy
+
+  def _set_matrices(self, well_alphas, well_betas):
+    self.well_alphas, self.well_betas = well_alphas, well_betas
+    self.alpha_wells = self.well_alphas.T.tocsr()
+    self.beta_wells = self.well_betas.T.tocsr()
+
+    self.alpha_counts = np.diff(self.alpha_wells.indptr)
+    self.beta_counts = np.diff(self.beta_wells.indptr)
+    self.well_alpha_counts = np.diff(self.well_alphas.indptr)
+    self.well_beta_counts = np.diff(self.well_betas.indptr)
+
+    self.alpha_bits, self.beta_bits = None, None
+
+  @staticmethod
+  def _build_matrix(chains_per_well, chain_to_idx):
+    # Builds a (num wells x num chains) CSR matrix directly from its index arrays
+    indptr = np.zeros(len(chains_per_well)+1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(chains) for chains in chains_per_well])
+    indices = np.fromiter((chain_to_idx[c] for chains in chains_per_well for c in chains), dtype=np.int32, count=indptr[-1])
+    return WellOccupancy._csr_from_indices(indptr, indices, len(chain_to_idx))
+
+  @staticmethod
+  def _csr_from_indices(indptr, indices, num_chains):
+    # (num wells x num chains) 0/1 CSR matrix from per-well chain row indices
+    # Chains listed more than once in a well (e.g. a misplaced copy) are only counted once
+    indptr, indices = np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int32)
+    data = np.ones(len(indices), dtype=np.int32)
+    mat = scipy.sparse.csr_matrix((data, indices, indptr), shape=(len(indptr)-1, num_chains))
+    mat.sum_duplicates()
+    mat.data[:] = 1
+    return mat
+
+  def well_alpha_idx(self, well_id):
+    # Sorted row indices of the alpha-chains in the given well
+    return self.well_alphas.indices[self.well_alphas.indptr[well_id]:self.well_alphas.indptr[well_id+1]]
+  def well_beta_idx(self, well_id):
+    # Sorted row indices of the beta-chains in the given well
+    return self.well_betas.indices[self.well_betas.indptr[well_id]:self.well_betas.indptr[well_id+1]]
+
+  def pack_wells(self, well_mask):
+    # Packs a boolean mask over wells into a bitset in the same layout as chain_bitsets()
+    return np.packbits(np.asarray(well_mask, dtype=bool))
+
+  def chain_bitsets(self):
+    # Returns (alpha_bits, beta_bits), where bit w of row i is set iff chain i occurs in well w
+    if self.alpha_bits is None:
+      self.alpha_bits = WellOccupancy._build_bitsets(self.alpha_wells)
+      self.beta_bits = WellOccupancy._build_bitsets(self.beta_wells)
+    return self.alpha_bits, self.beta_bits
+
+  @staticmethod
+  def _build_bitsets(chain_wells):
+    # Packs each row of a (num chains x num wells) CSR matrix into a bitset without densifying it
+    bits = np.zeros((chain_wells.shape[0], (chain_wells.shape[1]+7)//8), dtype=np.uint8)
+    rows = np.repeat(np.arange(chain_wells.shape[0]), np.diff(chain_wells.indptr))
+    cols = chain_wells.indices
+    np.bitwise_or.at(bits, (rows, cols >> 3), (128 >> (cols & 7)).astype(np.uint8))
+    return bits
+
+  def cell_bitsets(self, cells):
+    # Returns a (num cells x ceil(num wells/8)) uint8 array whose row i is the set of wells containing every
+    # chain of cells[i] = (alist, blist), i.e. the bitwise AND of its chains' bitsets
+    # Chains that never occur give an empty set; a cell with no chains at all is in every well
+    alpha_bits, beta_bits = self.chain_bitsets()
+    num_bytes = alpha_bits.shape[1]
+    all_wells = self.pack_wells(np.ones(self.num_wells, dtype=bool))
+    # Row -1 of each table is the empty set, used for unobserved chains
+    alpha_table = np.vstack([alpha_bits, np.zeros((1, num_bytes), dtype=np.uint8)])
+    beta_table = np.vstack([beta_bits, np.zeros((1, num_bytes), dtype=np.uint8)])
+
+    # Cells are processed in groups with the same number of alpha and beta chains, so each group is
+    # a single gather and AND-reduction over fixed-size index arrays
+    groups = {}
+    for i,(alist,blist) in enumerate(cells):
+      groups.setdefault((len(alist), len(blist)), []).append(i)
+
+    result = np.empty((len(cells), num_bytes), dtype=np.uint8)
+    for (num_a, num_b), idx in groups.iteritems():
+      bits = np.tile(all_wells, (len(idx), 1))
+      if num_a > 0:
+        a_rows = np.array([[self.alpha_to_idx.get(a, -1) for a in cells[i][0]] for i in idx], dtype=np.int64)
+        bits &= np.bitwise_and.reduce(alpha_table[a_rows], axis=1)
+      if num_b > 0:
+        b_rows = np.array([[self.beta_to_idx.get(b, -1) for b in cells[i][1]] for i in idx], dtype=np.int64)
+        bits &= np.bitwise_and.reduce(beta_table[b_rows], axis=1)
+      result[idx] = bits
+    return result
+
+  def cooccurrence(self, wells = None, well_weights = None):
+    # Returns the (num alphas x num betas) sparse matrix whose (i,j) entry is the (weighted) number of
+    # wells, among the given subset of wells, in which alpha i and beta j both occur
+    alpha_wells, beta_wells = self.alpha_wells, self.beta_wells
+    if wells is not None:
+      alpha_wells, beta_wells = alpha_wells[:, wells], beta_wells[:, wells]
+    if well_weights is not None:
+      alpha_wells = alpha_wells * scipy.sparse.diags(np.asarray(well_weights, dtype=np.float64))
+    return (alpha_wells * beta_wells.T).tocsr()
+
+## Binary (.npz) plate format, used by SequencingData.save_data() and load_data()
+# Wells, cells and the bulky per-well generated_data lists are stored as CSR-style (indptr, values) array pairs;
+# everything else in the metadata is stored as a JSON blob
+BINARY_FORMAT_VERSION = 1
+# generated_data lists of per-well lists stored as CSR arrays
+_CSR_GENERATED_KEYS = ['cells_per_well_idx']
+# generated_data lists of per-well (alpha flags, beta flags) pairs stored as two CSR arrays each
+_PAIRED_CSR_GENERATED_KEYS = ['chain_deletions_per_well', 'chain_misplacements_per_well']
+# generated_data flat lists stored as plain arrays
+_ARRAY_GENERATED_KEYS = {'cells_per_well': np.int64, 'cell_frequencies': np.float64}
+
+def _lists_to_csr(lists, dtype = None):
+  # Concatenates a list of lists into (indptr, values) arrays
+  indptr = np.zeros(len(lists)+1, dtype=np.int64)
+  indptr[1:] = np.cumsum([len(l) for l in lists])
+  values = [v for l in lists for v in l]
+  if dtype is None and len(values) == 0:  dtype = np.int64
+  return indptr, np.array(values, dtype=dtype)
+
+def _csr_to_lists(indptr, values):
+  # Inverse of _lists_to_csr(), returning a list of python lists
+  values, indptr = values.tolist(), indptr.tolist()
+  return [values[indptr[i]:indptr[i+1]] for i in range(len(indptr)-1)]
+
+def _load_npz_arrays(path, mmap = False):
+  # Returns {name: array} for the arrays in a .npz file
+  # mmap: memory-map the uncompressed arrays read-only instead of reading them, so that only the pages
+  # that are touched get read, and processes opening the same file share one copy in the page cache
+  # (compressed arrays are always read into memory)
+  if not mmap:
+    f = np.load(path, allow_pickle=False)
+    arrays = {name: f[name] for name in f.files}
+    f.close()
+    return arrays
+
+  arrays = {}
+  zf = zipfile.ZipFile(path, 'r')
+  raw = open(path, 'rb')
+  try:
+    for info in zf.infolist():
+      name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+      if info.compress_type != zipfile.ZIP_STORED:
+        arrays[name] = np.lib.format.read_array(zf.open(info), allow_pickle=False)
+        continue
+      # Skip the member's local file header to find the start of its .npy data
+      raw.seek(info.header_offset)
+      local_header = struct.unpack('<4s5H3L2H', raw.read(30))
+      raw.seek(info.header_offset + 30 + local_header[9] + local_header[10])
+      version = np.lib.format.read_magic(raw)
+      if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(raw)
+      elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(raw)
+      else:
+        raise ValueError("Unsupported .npy format version {0} for array '{1}' in {2}".format(version, name, path))
+      if dtype.hasobject:
+        raise ValueError("Array '{0}' in {1} holds Python objects and cannot be memory-mapped".format(name, path))
+      if np.prod(shape) == 0:
+        arrays[name] = np.zeros(shape, dtype=dtype)
+      else:
+        arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=raw.tell(), shape=shape, order='F' if fortran_order else 'C')
+  finally:
+    raw.close()
+    zf.close()
+  return arrays
+
+def _load_cells(arrays):
+  cells_alphas = _csr_to_lists(arrays['cells_alphas_indptr'], arrays['cells_alphas'])
+  cells_betas = _csr_to_lists(arrays['cells_betas_indptr'], arrays['cells_betas'])
+  return [(tuple(alist), tuple(blist)) for alist, blist in zip(cells_alphas, cells_betas)]
+
+def _load_generated_data(arrays, generated):
+  # Fills in the generated_data entries that save_data_binary() moved into arrays
+  for key in _CSR_GENERATED_KEYS:
+    if 'gen_'+key in arrays:
+      generated[key] = _csr_to_lists(arrays['gen_{0}_indptr'.format(key)], arrays['gen_'+key])
+  for key in _PAIRED_CSR_GENERATED_KEYS:
+    if 'gen_{0}_alpha'.format(key) in arrays:
+      alpha_flags = _csr_to_lists(arrays['gen_{0}_alpha_indptr'.format(key)], arrays['gen_{0}_alpha'.format(key)])
+      beta_flags = _csr_to_lists(arrays['gen_{0}_beta_indptr'.format(key)], arrays['gen_{0}_beta'.format(key)])
+      generated[key] = [[a, b] for a, b in zip(alpha_flags, beta_flags)]
+  for key in _ARRAY_GENERATED_KEYS:
+    if 'gen_'+key in arrays:
+      generated[key] = arrays['gen_'+key].tolist()
+  return generated
+
+class LazyMetadata(dict):
+  """ Metadata dict in which some entries are only loaded on first access.
+    - loaders: dict mapping each lazy key to a function returning its value
+  A lazy key is loaded by metadata[key], metadata.get(key) or load_all(); until then `key in metadata` is True
+  but iterating over the dict (or json.dump'ing it) does not see it, so call load_all() before copying it.
+  """
+
+  def __init__(self, data, loaders):
+    dict.__init__(self, data)
+    self._loaders = dict(loaders)
+
+  def __missing__(self, key):
+    if key not in self._loaders:
+      raise KeyError(key)
+    self[key] = self._loaders.pop(key)()
+    return dict.__getitem__(self, key)
+
+  def __contains__(self, key):
+    return dict.__contains__(self, key) or key in self._loaders
+
+  def get(self, key, default = None):
+    return self[key] if key in self else default
+
+  def load_all(self):
+    for key in self._loaders.keys():
+      self[key]
+    return self
 
 class SequencingData(object):
-  def __init__(self, well_data=None, metadata=None, path=None):
+  def __init__(self, well_data=None, metadata=None, path=None, lazy=False):
+    # lazy: open binary (.npz) files memory-mapped (see load_data_binary())
+    self._occupancy = None
+    self._well_arrays = None
     if path is not None:
-      self.load_data(path)
+      self.load_data(path, lazy)
     else:
       self.well_data = well_data
       self.metadata = metadata
 
-  def load_data(self, path):
+  # Well data - list of [alpha_list, beta_list] per well
+  # Reassigning it discards the cached occupancy; modify wells in place only before calling get_occupancy()
+  # For lazily loaded data the lists are only built on first access
+  @property
+  def well_data(self):
+    if self._well_data is None and self._well_arrays is not None:
+      alpha_indptr, alphas, beta_indptr, betas = self._well_arrays
+      self._well_data = [[alist, blist] for alist, blist in zip(_csr_to_lists(alpha_indptr, alphas), _csr_to_lists(beta_indptr, betas))]
+      self._well_arrays = None
+    return self._well_data
+  @well_data.setter
+  def well_data(self, val):
+    self._well_data = val
+    self._well_arrays = None
+    self._occupancy = None
+
+  # Data files are JSON, or the binary format if the path ends in .npz
+  def load_data(self, path, lazy = False):
+    if path.endswith('.npz'):
+      return self.load_data_binary(path, lazy)
     data = json.load(open(path, 'r'))
     self.well_data = data['well_data']
     self.metadata = data['metadata']
     self.metadata['cells'] = [(tuple(alist), tuple(blist)) for alist, blist in self.metadata['cells']]
-  def save_data(self, path):
-    data = {'well_data': self.well_data, 'metadata': self.metadata}
+  def save_data(self, path, compress = False):
+    # compress: compress the arrays of a binary (.npz) file (smaller, but slower to load)
+    if path.endswith('.npz'):
+      return self.save_data_binary(path, compress)
+    data = {'well_data': self.well_data, 'metadata': self.get_metadata(load_all=True)}
     json.dump(data, open(path, 'w'))
-  def save_data_R(self, alpha_path, beta_path):
+
+  def save_data_binary(self, path, compress = False):
+    arrays = {}
+    arrays['well_alphas_indptr'], arrays['well_alphas'] = _lists_to_csr([alist for alist,_ in self.well_data])
+    arrays['well_betas_indptr'], arrays['well_betas'] = _lists_to_csr([blist for _,blist in self.well_data])
+
+    metadata = dict(self.get_metadata(load_all=True)) if self.metadata is not None else None
+    if metadata is not None and 'cells' in metadata:
+      cells = metadata.pop('cells')
+      arrays['cells_alphas_indptr'], arrays['cells_alphas'] = _lists_to_csr([alist for alist,_ in cells])
+      arrays['cells_betas_indptr'], arrays['cells_betas'] = _lists_to_csr([blist for _,blist in cells])
+    if metadata is not None and 'generated_data' in metadata:
+      generated = metadata['generated_data'] = dict(metadata['generated_data'])
+      for key in _CSR_GENERATED_KEYS:
+        if key in generated:
+          arrays['gen_{0}_indptr'.format(key)], arrays['gen_'+key] = _lists_to_csr(generated.pop(key))
+      for key in _PAIRED_CSR_GENERATED_KEYS:
+        if key in generated:
+          pairs = generated.pop(key)
+          arrays['gen_{0}_alpha_indptr'.format(key)], arrays['gen_{0}_alpha'.format(key)] = _lists_to_csr([a for a,_ in pairs], dtype=bool)
+          arrays['gen_{0}_beta_indptr'.format(key)], arrays['gen_{0}_beta'.format(key)] = _lists_to_csr([b for _,b in pairs], dtype=bool)
+      for key, dtype in _ARRAY_GENERATED_KEYS.iteritems():
+        if key in generated:
+          arrays['gen_'+key] = np.array(generated.pop(key), dtype=dtype)
+
+    header = {'format_version': BINARY_FORMAT_VERSION, 'metadata': metadata}
+    arrays['header_json'] = np.frombuffer(json.dumps(header), dtype=np.uint8)
+    if compress:
+      np.savez_compressed(path, **arrays)
+    else:
+      np.savez(path, **arrays)
+
+  def load_data_binary(self, path, lazy = False):
+    # lazy: memory-map the file rather than reading it. get_well_data(well_id) and get_occupancy() then read only
+    # the arrays they need, well_data lists are only built if well_data is accessed, and metadata['cells'] and
+    # metadata['generated_data'] are only loaded on first access (metadata is a LazyMetadata)
+    arrays = _load_npz_arrays(path, mmap=lazy)
+    header = json.loads(arrays['header_json'].tostring())
+    assert header['format_version'] <= BINARY_FORMAT_VERSION, "Unsupported binary data format version: {0}".format(header['format_version'])
+
+    self.well_data = None
+    self._well_arrays = (arrays['well_alphas_indptr'], arrays['well_alphas'], arrays['well_betas_indptr'], arrays['well_betas'])
+
+    metadata = header['metadata']
+    if metadata is not None:
+      loaders = {}
+      if 'cells_alphas' in arrays:
+        loaders['cells'] = lambda: _load_cells(arrays)
+      if 'generated_data' in metadata:
+        generated = metadata.pop('generated_data')
+        loaders['generated_data'] = lambda: _load_generated_data(arrays, generated)
+      metadata = LazyMetadata(metadata, loaders)
+      if not lazy:
+        metadata = dict(metadata.load_all())
+    self.metadata = metadata
+    if not lazy:
+      self.well_data
+  def save_data_R(self, alpha_path, beta_path, sparse = False, chunk_size = 1000):
     # saves data in a format usable with the R alphabetr implementation
+    # Rows (wells) are written as they are built from the occupancy index, so memory use does not grow with the plate
+    # sparse: write each matrix in MatrixMarket coordinate format (1-based well, chain+1, 1), readable in R with
+    # Matrix::readMM(), instead of dense comma-separated 0/1 rows; this takes time proportional to the non-zeros
     max_alpha = max([a for alist,_ in self.metadata['cells'] for a in alist])
     max_beta = max([b for _,blist in self.metadata['cells'] for b in blist])
 
-    alpha_data,beta_data = [],[]
-    for alist, blist in self.well_data:
-      alpha_row, beta_row = [0]*(max_alpha+1), [0]*(max_beta+1)
-      for a in alist:  alpha_row[a] = 1
-      for b in blist:  beta_row[b] = 1
-      alpha_data.append(alpha_row)
-      beta_data.append(beta_row)
-
-    f = open(alpha_path, 'w')
-    f.write('\n'.join([','.join([str(v) for v in arow]) for arow in alpha_data]))
-    f.close()
-
-    f = open(beta_path, 'w')
-    f.write('\n'.join([','.join([str(v) for v in brow]) for brow in beta_data]))
-    f.close() 
-      
-    
+    occupancy = self.get_occupancy()
+    for path, well_chains, labels, max_chain in [(alpha_path, occupancy.well_alphas, occupancy.alphas, max_alpha), (beta_path, occupancy.well_betas, occupancy.betas, max_beta)]:
+      labels = np.asarray(labels, dtype=np.int64)
+      f = open(path, 'w')
+      if sparse:
+        f.write('%%MatrixMarket matrix coordinate integer general\n')
+        f.write('{0} {1} {2}\n'.format(occupancy.num_wells, max_chain+1, well_chains.nnz))
+        for start in range(0, occupancy.num_wells, chunk_size):
+          rows = well_chains[start:start+chunk_size].tocoo()
+          entries = np.column_stack([rows.row+start+1, labels[rows.col]+1])
+          f.write(''.join(['{0} {1} 1\n'.format(w, c) for w, c in entries.tolist()]))
+      else:
+        # Each row is a copy of an all-zeros row with a '1' written at 2*chain for each chain in the well
+        zero_row = bytearray(','.join(['0']*(max_chain+1)))
+        for w in range(occupancy.num_wells):
+          row = zero_row[:]
+          for c in labels[well_chains.indices[well_chains.indptr[w]:well_chains.indptr[w+1]]].tolist():
+            row[2*c] = '1'
+          f.write(('\n' if w > 0 else '') + str(row))
+      f.close()
 
   def get_well_data(self, well_id = None):
     if well_id == None:
       return self.well_data
+    elif self._well_data is None and self._well_arrays is not None:
+      # Read just this well from the (memory-mapped) arrays
+      alpha_indptr, alphas, beta_indptr, betas = self._well_arrays
+      return [alphas[alpha_indptr[well_id]:alpha_indptr[well_id+1]].tolist(), betas[beta_indptr[well_id]:beta_indptr[well_id+1]].tolist()]
     else:
       return self.well_data[well_id]
 
-  def get_metadata(self):
+  def get_occupancy(self):
+    # Returns the WellOccupancy index for this data, building it on first use
+    # (directly from the chain arrays if the data was loaded lazily and well_data has not been built)
+    if self._occupancy is None:
+      if self._well_data is None and self._well_arrays is not None:
+        self._occupancy = WellOccupancy.from_csr(*self._well_arrays)
+      else:
+        self._occupancy = WellOccupancy(self.well_data)
+    return self._occupancy
+
+  def get_metadata(self, load_all = False):
+    # load_all: load any lazily loaded metadata entries first
+    if load_all and isinstance(self.metadata, LazyMetadata):
+      self.metadata.load_all()
     return self.metadata
@@ -0,0 +1,38 @@
+import os
+import sys
+import tempfile
+import time
+
+from seq_data import SequencingData
+from seq_generator import SequencingGenerator as SG
+
+## Benchmarks saving and loading SequencingData in the JSON and binary (.npz) formats
+## Usage: python seq_data_benchmark.py [num_wells] [cells_per_well] [num_cells]
+
+def time_call(func, *args):
+  start = time.time()
+  res = func(*args)
+  return res, time.time()-start
+
+def run_benchmark(num_wells = 5000, cells_per_well = 100, num_cells = 10000):
+  gen = SG(chain_deletion_prob = 0.15, chain_misplacement_prob = 0.01, num_wells = num_wells, seed = 0)
+  gen.set_cells_per_well('constant', cells_per_well = cells_per_well)
+  gen.cells = SG.generate_cells(num_cells, alpha_dual_prob = 0.1, seed = 0)
+  data = gen.generate_data()
+
+  print "Save/load benchmark: {0} wells, {1} cells/well, {2} cells".format(num_wells, cells_per_well, num_cells)
+
+  tmp_dir = tempfile.mkdtemp()
+  for name, ext, compress, lazy in [('JSON', '.json', False, False), ('Binary', '.npz', False, False), ('Binary (compressed)', '.npz', True, False), ('Binary (memory-mapped)', '.npz', False, True)]:
+    path = os.path.join(tmp_dir, 'data' + ext)
+    _, t_save = time_call(data.save_data, path, compress)
+    loaded, t_load = time_call(SequencingData, None, None, path, lazy)
+    _, t_occupancy = time_call(loaded.get_occupancy)
+    print "  {0}: {1:.1f} MB, save {2:.2f} s, load {3:.2f} s, occupancy index {4:.2f} s".format(name, os.path.getsize(path)/1e6, t_save, t_load, t_occupancy)
+    del loaded
+    os.remove(path)
+  os.rmdir(tmp_dir)
+
+if __name__ == '__main__':
+  args = [int(v) for v in sys.argv[1:]]
+  run_benchmark(*args)
@@ -1,3 +1,6 @@
+import json
+import multiprocessing
+import os
 import random
 
 import itertools as it
@@ -5,6 +8,36 @@ import numpy as np
 
 from seq_data import SequencingData
 
+## Chunks of wells generated by SequencingGenerator._iter_chunks()
+# Per-process state set by _init_generator_worker(), so the generator and the cell frequencies
+# are sent to each worker once rather than with every chunk
+_generator_state = {}
+
+def _init_generator_worker(generator, cell_freqs):
+  _generator_state['generator'] = generator
+  _generator_state['cell_freqs'] = cell_freqs
+
+def _generate_chunk(args):
+  # Samples one chunk of wells (see SequencingGenerator._iter_chunks())
+  # The chunk draws everything, including the destinations of its misplaced chains, from its own RandomState
+  # seeded by (seed, 1, chunk index), so the result does not depend on which process runs it
+  seed, chunk_idx, start, size, record_metadata = args
+  generator, cell_freqs = _generator_state['generator'], _generator_state['cell_freqs']
+  rand = np.random.RandomState([seed, 1, chunk_idx])
+
+  if generator.cells_per_well_distribution == 'explicit':
+    cells_per_well = generator.cells_per_well_distribution_params['cells_per_well'][start:start+size]
+  else:
+    cells_per_well = generator._sample_cells_per_well(size, rand)
+  cells_idx, well_data, misplaced_alphas, misplaced_betas, deletions, misplacements = generator._sample_wells(cells_per_well, cell_freqs, rand, record_metadata)
+
+  num_wells = generator._num_plate_wells()
+  misplaced = []
+  for chain_type, (_, chains) in enumerate([misplaced_alphas, misplaced_betas]):
+    misplaced.extend(zip(rand.randint(0, num_wells, len(chains)).tolist(), [chain_type]*len(chains), chains.tolist()))
+
+  return [int(cpw) for cpw in cells_per_well], well_data, misplaced, cells_idx, deletions, misplacements
+
 class SequencingGenerator(object):
   """ Encapsulates parameters for generating sequencing data from a simulated experiment.
   Accepts the following parameters:
@@ -22,6 +55,11 @@ class SequencingGenerator(object):
       - set_cell_frequency_distribution()
     Noise stuff
       - chain_misplacement_prob [READ/WRITE]
+      - chain_deletion_prob [READ/WRITE]
+    Random seed
+      - seed [READ/WRITE] (None draws a new seed from np.random for each data set)
+  Data is generated either all at once with generate_data(), or in chunks of wells with
+  iter_well_chunks()/save_data_stream() for plates too large to hold in memory.
   """ 
 
   def __init__(self, **kwargs):
@@ -33,6 +71,7 @@ class SequencingGenerator(object):
     self.set_cell_frequency_distribution(distro_type = 'power-law', alpha = -1)
     self.chain_misplacement_prob = 0
     self.chain_deletion_prob = 0
+    self.seed = None
 
     ## If any parameters are specified in kwargs, modify them from the defaults
     self.set_options(**kwargs)
@@ -102,6 +141,17 @@ class SequencingGenerator(object):
     self._cdp = prob
   
 
+
+  ## Random seed
+  # Seed of the per-chunk random streams used by generate_data(), iter_well_chunks() and save_data_stream()
+  @property
+  def seed(self):
+    return self._seed
+  @seed.setter
+  def seed(self, val):
+    self._seed = val
+  
+
   def set_options(self, **kwargs):
     if 'num_wells' in kwargs:
       self.num_wells = kwargs['num_wells']
@@ -115,86 +165,115 @@ class SequencingGenerator(object):
       self.chain_misplacement_prob = kwargs['chain_misplacement_prob']
     if 'chain_deletion_prob' in kwargs:
       self.chain_deletion_prob = kwargs['chain_deletion_prob']
+    if 'seed' in kwargs:
+      self.seed = kwargs['seed']
 
 
   @staticmethod
-  def generate_cells(num_cells, alpha_sharing_probs = None, beta_sharing_probs = None, alpha_dual_prob = 0.0, beta_dual_prob = 0.0, alpha_start_idx=0, beta_start_idx=0):
+  def generate_cells(num_cells, alpha_sharing_probs = None, beta_sharing_probs = None, alpha_dual_prob = 0.0, beta_dual_prob = 0.0, alpha_start_idx=0, beta_start_idx=0, seed=None, exact=False):
+    # seed: seed for a private RandomState (if None, the global np.random state is used)
+    # exact: top up with extra clones until there are exactly num_cells distinct cells
+    rand = np.random.RandomState(seed) if seed is not None else np.random
     if alpha_sharing_probs is None:
       alpha_sharing_probs = [0.816,0.085,0.021,0.007,0.033,0.005,0.033]
     if beta_sharing_probs is None:
       beta_sharing_probs = [0.859,0.076,0.037,0.019,0.009]
 
     # Generate the degree for each alpha- and beta-chain from the given distribution
-    adegs = np.random.choice(range(1,len(alpha_sharing_probs)+1), num_cells, replace=True, p=alpha_sharing_probs)
-    bdegs = np.random.choice(range(1,len(beta_sharing_probs)+1), num_cells, replace=True, p=beta_sharing_probs)
+    adegs = rand.choice(range(1,len(alpha_sharing_probs)+1), num_cells, replace=True, p=alpha_sharing_probs)
+    bdegs = rand.choice(range(1,len(beta_sharing_probs)+1), num_cells, replace=True, p=beta_sharing_probs)
 
     # Generate how many alpha- and beta-chains will be in each cell (i.e. how many dual chains)
-    adual = [2 if v<=alpha_dual_prob else 1 for v in np.random.uniform(size=num_cells)]
-    bdual = [2 if v<=beta_dual_prob else 1 for v in np.random.uniform(size=num_cells)]
+    adual = np.where(rand.uniform(size=num_cells)<=alpha_dual_prob, 2, 1)
+    bdual = np.where(rand.uniform(size=num_cells)<=beta_dual_prob, 2, 1)
 
     # Cut off at the desired number of cells
-    alphas = [(i,) for i,n in enumerate(adegs) for _ in range(n)][:sum(adual)] # this truncation will alter the distro somewhat
-    betas = [(i,) for i,n in enumerate(bdegs) for _ in range(n)][:sum(bdual)]
+    alphas = np.repeat(np.arange(alpha_start_idx, alpha_start_idx+num_cells), adegs)[:adual.sum()] # this truncation will alter the distro somewhat
+    betas = np.repeat(np.arange(beta_start_idx, beta_start_idx+num_cells), bdegs)[:bdual.sum()]
 
     # Randomly assign alpha- and beta-chains to each other
-    np.random.shuffle(alphas)
-    np.random.shuffle(betas)
-    for i in range(num_cells):
-      if adual[i]==2:  alphas[i:i+2] = [tuple(sorted(alphas[i]+alphas[i+1]))]
-      if bdual[i]==2:  betas[i:i+2] = [tuple(sorted(betas[i]+betas[i+1]))]
-    cells = list(set(zip(alphas, betas))) # Due to random duplicates, there may be slightly less than num_cells cells
-    # (A slightly more complex method could be used to ensure exactly num_cells cells)
+    # Cell i takes the next adual[i] chains of the shuffled alphas (and likewise for betas)
+    rand.shuffle(alphas)
+    rand.shuffle(betas)
+    def chains_per_cell(chains, dual):
+      starts = np.cumsum(dual) - dual
+      dual, starts = dual[starts+dual <= len(chains)], starts[starts+dual <= len(chains)] # drop cells the pool ran out for
+      first = chains[starts].tolist()
+      second = chains[np.minimum(starts+1, len(chains)-1)].tolist()
+      return [(c1,) if d==1 else tuple(sorted((c1,c2))) for c1,c2,d in zip(first, second, dual.tolist())]
+    cells = list(set(zip(chains_per_cell(alphas, adual), chains_per_cell(betas, bdual)))) # Due to random duplicates, there may be slightly less than num_cells cells
+
+    # Top up with clones built from fresh chains, which cannot repeat any existing clone
+    next_alpha, next_beta = alpha_start_idx+num_cells, beta_start_idx+num_cells
+    while exact and len(cells) < num_cells:
+      num_extra = num_cells - len(cells)
+      cells.extend(SequencingGenerator.generate_cells(num_extra, alpha_sharing_probs, beta_sharing_probs, alpha_dual_prob, beta_dual_prob, next_alpha, next_beta, seed=rand.randint(2**31)))
+      next_alpha, next_beta = next_alpha+num_extra, next_beta+num_extra
 
     return cells
 
   @staticmethod
-  def generate_cells_lee(num_cells, max_alphas=None, max_betas=None):
+  def generate_cells_lee(num_cells, max_alphas=None, max_betas=None, seed=None, exact=False):
+    # seed: seed for a private RandomState (if None, the global np.random state is used)
+    # exact: top up with extra clones until there are exactly num_cells distinct cells
+    rand = np.random.RandomState(seed) if seed is not None else np.random
     if max_alphas == None:  max_alphas = num_cells
     if max_betas == None:  max_betas = num_cells
 
     # Generate the degree for each alpha- and beta-chain from a given distribution
     sharing_probs=[0.8375, 0.0805, 0.029, 0.013, 0.021, 0.0025, 0.0165] # Averages from the Lee et al. paper
-    adegs = np.random.choice(range(1,8), max_alphas, replace=True, p=sharing_probs)
-    bdegs = np.random.choice(range(1,8), max_betas, replace=True, p=sharing_probs)
+    adegs = rand.choice(range(1,8), max_alphas, replace=True, p=sharing_probs)
+    bdegs = rand.choice(range(1,8), max_betas, replace=True, p=sharing_probs)
 
     # If you want to generate from a power law instead (not sure if this works as expected)
     #adegs = np.floor(np.random.pareto(2.1, size=max_alphas))+1
     #bdegs = np.floor(np.random.pareto(2.1, size=max_alphas))+1
 
     # Cut off at the desired number of cells
-    alphas = sum([[i]*int(n) for i,n in enumerate(adegs)],[])[:num_cells] # this trunc. will skew the distro a bit
-    betas = sum([[i]*int(n) for i,n in enumerate(bdegs)], [])[:num_cells]
+    alphas = np.repeat(np.arange(max_alphas), adegs)[:num_cells] # this trunc. will skew the distro a bit
+    betas = np.repeat(np.arange(max_betas), bdegs)[:num_cells]
 
     # Randomly assign alpha- and beta-chains to each other
-    np.random.shuffle(alphas)
-    np.random.shuffle(betas)
-    cells = list(set(zip(alphas, betas))) # Due to chance dups, there may be slightly less than num_cells cells
-    
-    # (A slightly more complex method could be used to ensure exactly num_cells cells)
+    rand.shuffle(alphas)
+    rand.shuffle(betas)
+    cells = list(set(zip(alphas.tolist(), betas.tolist()))) # Due to chance dups, there may be slightly less than num_cells cells
+
+    # Top up with clones built from fresh chains (numbered after all earlier ones), which cannot repeat any existing clone
+    alpha_offset, beta_offset = max_alphas, max_betas
+    while exact and len(cells) < num_cells:
+      num_extra = num_cells - len(cells)
+      extra = SequencingGenerator.generate_cells_lee(num_extra, seed=rand.randint(2**31))
+      cells.extend([(a+alpha_offset, b+beta_offset) for a,b in extra])
+      alpha_offset, beta_offset = alpha_offset+num_extra, beta_offset+num_extra
+
     return cells
 
-  def _sample_cells_per_well(self):
+  def _sample_cells_per_well(self, num_wells = None, rand = np.random):
     # Generate a list of number of cells for each well, based on the specified distribution
     # This is called to generate a new list each time generate_sequencing_data() is called.
+    # num_wells: number of wells to sample (defaults to self.num_wells; not used by 'explicit')
+    # rand: numpy RandomState (or the np.random module) to draw from
+    if num_wells is None:  num_wells = self.num_wells
     distro = self.cells_per_well_distribution
     params = self.cells_per_well_distribution_params
     if distro == 'constant':
-      return [params['cells_per_well']] * self.num_wells
+      return [params['cells_per_well']] * num_wells
     elif distro == 'poisson':
-      return list(np.random.poisson(params['lam'], self.num_wells))
+      return list(rand.poisson(params['lam'], num_wells))
     elif distro == 'explicit':
       return params['cells_per_well']
     else:
       assert False, "Unknown distribution of cells/well: {0}".format(distro)
-  def _sample_cell_freqs(self):
+  def _sample_cell_freqs(self, rand = None):
     # Generate a list of cell frequencies based on the specified distribution
     # This is called each time generate_sequencing_data() is called.
+    # rand: numpy RandomState to draw from (if None, the global np.random and random states are used)
     distro = self.cell_frequency_distribution
     params = self.cell_frequency_distribution_params
     if distro == 'constant':
       freqs = np.array([1]*len(self.cells))
     elif distro == 'power-law':
-      freqs = np.random.pareto(-params['alpha'], len(self.cells)) ## TODO: there's something screwy abt this distro, talk to holec abt it
+      freqs = (rand or np.random).pareto(-params['alpha'], len(self.cells)) ## TODO: there's something screwy abt this distro, talk to holec abt it
     elif distro == 'Lee':
       p_s = params.get('p_s', 0.5)
       n_s = params.get('n_s', 10)
@@ -202,7 +281,8 @@ class SequencingGenerator(object):
       freq_n_s = 1.1*freq_min # lowest clone frequency within top p_s
       r = 2.*(p_s-freq_n_s*n_s)/((n_s-1)*n_s) # freq step size within top p_s
       freqs = [freq_n_s+r*i for i in range(n_s)] + [freq_min]*(len(self.cells)-n_s)
-      random.shuffle(freqs)
+      if rand is None:  random.shuffle(freqs)
+      else:  rand.shuffle(freqs)
     elif distro == 'explicit':
       freqs = np.array(params['frequencies'])
     else:
@@ -211,13 +291,76 @@ class SequencingGenerator(object):
     freqs = freqs / np.sum(freqs) # Normalize freqs so it is a probability distro
     return list(freqs)
 
-  def generate_data(self):
-    # Generates sequencing data based on this SequencingGenerator object's parameter values.
-    # Results are returned in a SequencingData object, which can be saved to a file with seq_data.save()
-
-    cells_per_well = self._sample_cells_per_well()
-    cell_freqs = self._sample_cell_freqs()
-
+  def _sample_well(self, cpw, cell_freqs):
+    # Samples the contents of one well of cpw cells
+    # Returns the cell indices, the alpha- and beta-chains that were sequenced in the well, the chains that were
+    # misplaced out of it (not yet assigned to another well), and the deletion/misplacement flags of every chain
+
+    # Pick cpw cells based on distro in cell_freqs
+    # TODO: use trees to do this in O(log n) time?
+    # (tbh: i actually don't know the efficiency of numpy's algorithm)
+    cells_idx = np.random.choice(range(len(self.cells)), cpw, replace=True, p=cell_freqs)
+    cells = [self.cells[idx] for idx in cells_idx]
+
+    # Extract alpha and beta chains in the well
+    alphas, betas = zip(*cells) if len(cells)>0 else ([],[])
+    alphas, betas = [a for alist in alphas for a in alist], [b for blist in betas for b in blist]
+
+    # Apply chain deletions and chain misplacements
+    alphas_del_flag = [bool(v<self.chain_deletion_prob) for v in np.random.uniform(size=len(alphas))]
+    alphas_misp_flag = [bool(v<self.chain_misplacement_prob) for v in np.random.uniform(size=len(alphas))]
+    misplaced_alphas = [a for a,deleted,misplaced in zip(alphas, alphas_del_flag, alphas_misp_flag) if misplaced and not deleted]
+    alphas = [a for a,deleted,misplaced in zip(alphas, alphas_del_flag, alphas_misp_flag) if not deleted and not misplaced]
+
+    betas_del_flag = [bool(v<self.chain_deletion_prob) for v in np.random.uniform(size=len(betas))]
+    betas_misp_flag = [bool(v<self.chain_misplacement_prob) for v in np.random.uniform(size=len(betas))]
+    misplaced_betas = [b for b,deleted,misplaced in zip(betas, betas_del_flag, betas_misp_flag) if misplaced and not deleted]
+    betas = [b for b,deleted,misplaced in zip(betas, betas_del_flag, betas_misp_flag) if not deleted and not misplaced]
+
+    return cells_idx, alphas, betas, misplaced_alphas, misplaced_betas, (alphas_del_flag, betas_del_flag), (alphas_misp_flag, betas_misp_flag)
+
+  def _num_plate_wells(self):
+    # Number of wells actually generated ('explicit' cells/well lists fix their own number of wells)
+    if self.cells_per_well_distribution == 'explicit':
+      return len(self.cells_per_well_distribution_params['cells_per_well'])
+    return self.num_wells
+
+  def _plate_seed(self):
+    # Seed of this data set's random streams: self.seed, or one drawn from np.random (so that seeding numpy's
+    # global state still makes runs reproducible)
+    return self.seed if self.seed is not None else np.random.randint(2**31)
+
+  def _iter_chunks(self, seed, cell_freqs, chunk_size = 1000, n_jobs = 1, record_metadata = True):
+    # Yields (start, results of _generate_chunk()) for each run of chunk_size consecutive wells, in order
+    # Every chunk has its own random stream, so for a given seed and chunk_size the output is identical
+    # regardless of n_jobs (-1 uses every core). Chunks are farmed out a few batches ahead of the consumer,
+    # so memory stays bounded when the chunks are being streamed to disk
+    if n_jobs == -1:  n_jobs = multiprocessing.cpu_count()
+    num_wells = self._num_plate_wells()
+    tasks = [(seed, chunk_idx, start, min(chunk_size, num_wells-start), record_metadata) for chunk_idx, start in enumerate(range(0, num_wells, chunk_size))]
+
+    if n_jobs > 1:
+      pool = multiprocessing.Pool(n_jobs, initializer=_init_generator_worker, initargs=(self, cell_freqs))
+      batch_size = 4*n_jobs
+    else:
+      pool = None
+      _init_generator_worker(self, cell_freqs)
+      batch_size = 1
+
+    try:
+      for batch_start in range(0, len(tasks), batch_size):
+        batch = tasks[batch_start:batch_start+batch_size]
+        results = pool.map(_generate_chunk, batch) if pool is not None else map(_generate_chunk, batch)
+        for task, result in zip(batch, results):
+          yield task[2], result
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+      _generator_state.clear()
+
+  def _generate_wells_serial(self, cells_per_well, cell_freqs):
+    # Per-well sampler used by generate_data(vectorized=False)
     misplaced_alphas = []
     misplaced_betas = []
     well_data = []
@@ -225,26 +368,9 @@ class SequencingGenerator(object):
     chain_deletions = []
     chain_misplacements = []
     for cpw in cells_per_well:
-      # Pick cpw cells based on distro in cell_freqs
-      # TODO: use trees to do this in O(log n) time?
-      # (tbh: i actually don't know the efficiency of numpy's algorithm)
-      cells_idx = np.random.choice(range(len(self.cells)), cpw, replace=True, p=cell_freqs)
-      cells = [self.cells[idx] for idx in cells_idx]
-
-      # Extract alpha and beta chains in the well
-      alphas, betas = zip(*cells) if len(cells)>0 else ([],[])
-      alphas, betas = [a for alist in alphas for a in alist], [b for blist in betas for b in blist]
-
-      # Apply chain deletions and chain misplacements
-      alphas_del_flag = [bool(v<self.chain_deletion_prob) for v in np.random.uniform(size=len(alphas))]
-      alphas_misp_flag = [bool(v<self.chain_misplacement_prob) for v in np.random.uniform(size=len(alphas))]
-      misplaced_alphas.extend([a for a,deleted,misplaced in zip(alphas, alphas_del_flag, alphas_misp_flag) if misplaced and not deleted])
-      alphas = [a for a,deleted,misplaced in zip(alphas, alphas_del_flag, alphas_misp_flag) if not deleted and not misplaced]
-
-      betas_del_flag = [bool(v<self.chain_deletion_prob) for v in np.random.uniform(size=len(betas))]
-      betas_misp_flag = [bool(v<self.chain_misplacement_prob) for v in np.random.uniform(size=len(betas))]
-      misplaced_betas.extend([b for b,deleted,misplaced in zip(betas, betas_del_flag, betas_misp_flag) if misplaced and not deleted])
-      betas = [b for b,deleted,misplaced in zip(betas, betas_del_flag, betas_misp_flag) if not deleted and not misplaced] 
+      cells_idx, alphas, betas, misp_alphas, misp_betas, deletions, misplacements = self._sample_well(cpw, cell_freqs)
+      misplaced_alphas.extend(misp_alphas)
+      misplaced_betas.extend(misp_betas)
 
       # Remove duplicate chains and add to well_data
       well_data.append([sorted(set(alphas)), sorted(set(betas))])
@@ -253,12 +379,123 @@ class SequencingGenerator(object):
       cells_per_well_idx.append(list(cells_idx))
 
       # Store record of chain deletions and misplacements
-      chain_deletions.append((alphas_del_flag, betas_del_flag))
-      chain_misplacements.append((alphas_misp_flag, betas_misp_flag))
+      chain_deletions.append(deletions)
+      chain_misplacements.append(misplacements)
 
     # Put misplaced chains in random wells
     for a in misplaced_alphas:  well_data[np.random.randint(0, len(well_data))][0].append(a)
     for b in misplaced_betas:  well_data[np.random.randint(0, len(well_data))][1].append(b)
+
+    return well_data, cells_per_well_idx, chain_deletions, chain_misplacements
+
+  def _cell_chain_arrays(self):
+    # CSR layout of the chains of each cell: the alpha-chains of cell i are
+    # alpha_chains[alpha_indptr[i]:alpha_indptr[i+1]], and likewise for beta-chains
+    arrays = []
+    for chain_lists in zip(*self.cells) if len(self.cells)>0 else ([], []):
+      indptr = np.zeros(len(chain_lists)+1, dtype=np.int64)
+      indptr[1:] = np.cumsum([len(chains) for chains in chain_lists])
+      arrays.append((indptr, np.array([c for chains in chain_lists for c in chains])))
+    return arrays
+
+  def _sample_wells(self, cells_per_well, cell_freqs, rand = np.random, record_metadata = True):
+    # Vectorized _sample_well() for a whole list of wells at once
+    #  - cells for all wells are drawn in one searchsorted on the cumulative frequencies
+    #  - each drawn cell is expanded into its chains through the CSR cell->chain arrays
+    #  - deletions and misplacements are masks over all chains of all wells
+    #  - chains are de-duplicated and sorted within wells with a single lexsort
+    # Returns the cell indices of each well, the well data (sorted distinct chains, misplaced chains not yet
+    # added), the (source well, chain) arrays of misplaced alphas and betas, and the per-well deletion and
+    # misplacement flags, in the same formats as generate_data() records them
+    # rand: numpy RandomState (or the np.random module) to draw from
+    # record_metadata: if False, None is returned in place of the cell indices and flags
+    cells_per_well = np.asarray(cells_per_well, dtype=np.int64)
+    num_wells = len(cells_per_well)
+    cum_freqs = np.cumsum(cell_freqs)
+    cells_idx = np.searchsorted(cum_freqs, rand.uniform(0, cum_freqs[-1], size=cells_per_well.sum()), side='right')
+    cells_idx = np.minimum(cells_idx, len(cum_freqs)-1)
+    cell_wells = np.repeat(np.arange(num_wells), cells_per_well)
+    cell_bounds = np.concatenate([[0], np.cumsum(cells_per_well)])
+
+    results = []
+    for indptr, chains in self._cell_chain_arrays():
+      # Chains of every drawn cell, in the same order as the per-well sampler lists them
+      counts = np.diff(indptr)[cells_idx]
+      ends = np.cumsum(counts)
+      chain_idx = np.repeat(indptr[cells_idx] - (ends-counts), counts) + np.arange(ends[-1] if len(ends)>0 else 0)
+      chain_vals = chains[chain_idx]
+      chain_wells = np.repeat(cell_wells, counts)
+      chain_bounds = np.searchsorted(chain_wells, np.arange(num_wells+1))
+
+      deleted = rand.uniform(size=len(chain_vals)) < self.chain_deletion_prob
+      misplaced = rand.uniform(size=len(chain_vals)) < self.chain_misplacement_prob
+      misplaced_out = misplaced & ~deleted
+      kept = ~deleted & ~misplaced
+
+      # Sorted, distinct chains of each well
+      kept_wells, kept_vals = chain_wells[kept], chain_vals[kept]
+      if kept_vals.dtype.kind in 'iu' and len(kept_vals) > 0:
+        # Integer chain ids: sort on a single (well, chain) key, which is much faster than a lexsort
+        min_val = kept_vals.min()
+        span = int(kept_vals.max() - min_val) + 1
+        keys = np.unique(kept_wells*span + (kept_vals - min_val))
+        kept_wells, kept_vals = keys // span, keys % span + min_val
+      else:
+        order = np.lexsort((kept_vals, kept_wells))
+        kept_wells, kept_vals = kept_wells[order], kept_vals[order]
+        distinct = np.ones(len(kept_vals), dtype=bool)
+        distinct[1:] = (kept_wells[1:] != kept_wells[:-1]) | (kept_vals[1:] != kept_vals[:-1])
+        kept_wells, kept_vals = kept_wells[distinct], kept_vals[distinct]
+      kept_vals = kept_vals.tolist()
+      well_bounds = np.searchsorted(kept_wells, np.arange(num_wells+1)).tolist()
+
+      if record_metadata:
+        deleted, misplaced, chain_bounds = deleted.tolist(), misplaced.tolist(), chain_bounds.tolist()
+        deleted = [deleted[chain_bounds[i]:chain_bounds[i+1]] for i in range(num_wells)]
+        misplaced = [misplaced[chain_bounds[i]:chain_bounds[i+1]] for i in range(num_wells)]
+      results.append((
+        [kept_vals[well_bounds[i]:well_bounds[i+1]] for i in range(num_wells)],
+        (chain_wells[misplaced_out], chain_vals[misplaced_out]),
+        deleted,
+        misplaced
+      ))
+    (alpha_wells, misplaced_alphas, alpha_del, alpha_misp), (beta_wells, misplaced_betas, beta_del, beta_misp) = results
+    well_data = [list(chains) for chains in zip(alpha_wells, beta_wells)]
+
+    if not record_metadata:
+      return None, well_data, misplaced_alphas, misplaced_betas, None, None
+    cells_idx, cell_bounds = cells_idx.tolist(), cell_bounds.tolist()
+    cells_per_well_idx = [cells_idx[cell_bounds[i]:cell_bounds[i+1]] for i in range(num_wells)]
+    return cells_per_well_idx, well_data, misplaced_alphas, misplaced_betas, zip(alpha_del, beta_del), zip(alpha_misp, beta_misp)
+
+  def generate_data(self, vectorized = True, n_jobs = 1, chunk_size = 1000):
+    # Generates sequencing data based on this SequencingGenerator object's parameter values.
+    # Results are returned in a SequencingData object, which can be saved to a file with seq_data.save()
+    # vectorized: sample chunks of chunk_size wells at a time with _sample_wells(), each from its own random stream
+    # seeded by self.seed, spread over n_jobs processes (-1 uses every core). For a given seed and chunk_size the
+    # data is identical regardless of n_jobs. If False, wells are sampled one at a time from the global random
+    # state, drawing random numbers in the same order as older versions, to reproduce old runs
+
+    if vectorized:
+      seed = self._plate_seed()
+      cell_freqs = self._sample_cell_freqs(np.random.RandomState([seed, 0]))
+
+      cells_per_well, well_data, misplaced, cells_per_well_idx, chain_deletions, chain_misplacements = [], [], [], [], [], []
+      for _, (cpw_chunk, well_data_chunk, misplaced_chunk, cells_idx_chunk, deletions_chunk, misplacements_chunk) in self._iter_chunks(seed, cell_freqs, chunk_size, n_jobs):
+        cells_per_well.extend(cpw_chunk)
+        well_data.extend(well_data_chunk)
+        misplaced.extend(misplaced_chunk)
+        cells_per_well_idx.extend(cells_idx_chunk)
+        chain_deletions.extend(deletions_chunk)
+        chain_misplacements.extend(misplacements_chunk)
+
+      # Put misplaced chains in their (already drawn) destination wells
+      for w, chain_type, chain in misplaced:  well_data[w][chain_type].append(chain)
+    else:
+      seed = None
+      cells_per_well = self._sample_cells_per_well()
+      cell_freqs = self._sample_cell_freqs()
+      well_data, cells_per_well_idx, chain_deletions, chain_misplacements = self._generate_wells_serial(cells_per_well, cell_freqs)
       
     metadata = {
       'num_wells': self.num_wells,
@@ -272,8 +509,82 @@ class SequencingGenerator(object):
         'cells_per_well_idx': cells_per_well_idx,
         'chain_deletions_per_well': chain_deletions,
         'chain_misplacements_per_well': chain_misplacements,
-        'cell_frequencies': cell_freqs
+        'cell_frequencies': cell_freqs,
+        'seed': seed
       }
     }
     seq_data = SequencingData(well_data = well_data, metadata = metadata)
     return seq_data
+
+  def iter_well_chunks(self, chunk_size = 1000, cell_freqs = None, n_jobs = 1, seed = None):
+    # Generates sequencing data a chunk of wells at a time, without holding the whole plate in memory.
+    # Yields (start, cells_per_well, well_data, misplaced) for each run of chunk_size consecutive wells, where
+    # well_data holds the chunk's wells starting at well index start, and misplaced is a list of
+    # (destination well, 0 for alpha/1 for beta, chain) for chains misplaced out of the chunk. The destination
+    # can be any well on the plate, so misplaced chains are not yet included in any well_data.
+    # Per-well metadata (cell indices, deletion and misplacement flags) is not recorded.
+    # cell_freqs: cell frequencies to sample from (sampled from the frequency distribution if not given)
+    # n_jobs, seed: as in generate_data() (seed defaults to self.seed); chunks are the same for any n_jobs
+    if seed is None:  seed = self._plate_seed()
+    if cell_freqs is None:  cell_freqs = self._sample_cell_freqs(np.random.RandomState([seed, 0]))
+    for start, (cells_per_well, well_data, misplaced, _, _, _) in self._iter_chunks(seed, cell_freqs, chunk_size, n_jobs, record_metadata=False):
+      yield start, cells_per_well, well_data, misplaced
+
+  def save_data_stream(self, path, chunk_size = 1000, n_jobs = 1):
+    # Generates sequencing data chunk by chunk with iter_well_chunks() and writes it straight to path, in the
+    # same format as SequencingData.save_data() (so it can be read back with SequencingData(path=path)).
+    # Memory use is bounded by the chunk size plus the misplaced chains, which are kept as compact arrays:
+    #  1. wells are written to a temporary file (one JSON list per line) as they are sampled
+    #  2. if any chains were misplaced, a second pass reads the wells back a chunk at a time and
+    #     appends the misplaced chains destined for that chunk
+    # Wells are sampled on n_jobs processes, with the same seeding as generate_data().
+    # Returns the metadata written (generated_data only holds cells_per_well, cell_frequencies and seed).
+    tmp_path = path + '.wells.tmp'
+    seed = self._plate_seed()
+    cell_freqs = self._sample_cell_freqs(np.random.RandomState([seed, 0]))
+    cells_per_well = []
+    misplaced = []
+    tmp_file = open(tmp_path, 'w')
+    for start, cpw_chunk, well_data, misplaced_chunk in self.iter_well_chunks(chunk_size, cell_freqs, n_jobs, seed):
+      for well in well_data:
+        tmp_file.write(json.dumps(well) + '\n')
+      cells_per_well.append(np.array(cpw_chunk, dtype=np.int32))
+      if len(misplaced_chunk) > 0:
+        misplaced.append(np.array(misplaced_chunk, dtype=np.int64).reshape(-1, 3))
+    tmp_file.close()
+    cells_per_well = np.concatenate(cells_per_well) if len(cells_per_well) > 0 else np.zeros(0, dtype=np.int32)
+
+    # Misplaced chains, sorted by destination well (stable, so chains keep their sampling order)
+    misplaced = np.concatenate(misplaced) if len(misplaced) > 0 else np.zeros((0, 3), dtype=np.int64)
+    misplaced = misplaced[np.argsort(misplaced[:,0], kind='mergesort')]
+    misplaced_bounds = np.searchsorted(misplaced[:,0], np.arange(self._num_plate_wells()+1))
+
+    f = open(path, 'w')
+    f.write('{"well_data": [')
+    tmp_file = open(tmp_path, 'r')
+    for well_idx, line in enumerate(tmp_file):
+      if misplaced_bounds[well_idx] < misplaced_bounds[well_idx+1]:
+        well = json.loads(line)
+        for _, chain_type, chain in misplaced[misplaced_bounds[well_idx]:misplaced_bounds[well_idx+1]].tolist():
+          well[chain_type].append(chain)
+        line = json.dumps(well)
+      f.write((', ' if well_idx > 0 else '') + line.rstrip('\n'))
+    tmp_file.close()
+    os.remove(tmp_path)
+
+    metadata = {
+      'num_wells': self.num_wells,
+      'cells_per_well_distribution': self.cells_per_well_distribution,
+      'cells_per_well_distribution_params': self.cells_per_well_distribution_params,
+      'cells': self.cells,
+      'cell_frequency_distribution': self.cell_frequency_distribution,
+      'cell_frequency_distribution_params': self.cell_frequency_distribution_params,
+      'generated_data': {
+        'cells_per_well': cells_per_well.tolist(),
+        'cell_frequencies': [float(freq) for freq in cell_freqs],
+        'seed': seed
+      }
+    }
+    f.write('], "metadata": ' + json.dumps(metadata) + '}')
+    f.close()
+    return metadata
@@ -19,6 +19,8 @@ import time
 # nonstandard libraries
 import numpy as np
 import scipy.misc
+import scipy.sparse
+import scipy.special
 #import matplotlib.pyplot as plt
 #from seq_generator import SequencingGenerator as SeqGen
 #from seq_data import SequencingData
@@ -86,6 +88,81 @@ def instance_probability(w_ab,w_a,w_b,w_tot,f_ab,f_a,f_b):
     c =  nCk(w_tot-(w_a+w_ab),w_b)*(f_b**w_b)*((1-f_b)**(w_tot-(w_a+w_b+w_ab)))
     return a*b*c
 
+'''
+Vectorized Probability Calculators
+    Array versions of the calculators above, evaluated in natural log space
+    Inputs broadcast against each other; w_tot is a scalar
+'''
+
+# log of N choose K (-inf where K is out of range)
+def log_nCk(n, r):
+    n,r = np.asarray(n,dtype=np.float64),np.asarray(r,dtype=np.float64)
+    valid = (r >= 0) & (r <= n)
+    n,r = np.where(valid,n,0.),np.where(valid,r,0.)
+    return np.where(valid,scipy.special.gammaln(n+1) - scipy.special.gammaln(r+1) - scipy.special.gammaln(n-r+1),-np.inf)
+
+# log probability of k successes out of n trials with success probability f
+def log_binomial(k, n, f):
+    k,n = np.asarray(k,dtype=np.float64),np.asarray(n,dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        val = log_nCk(n,k) + scipy.special.xlogy(k,f) + scipy.special.xlog1py(n-k,-f)
+    return np.where((k >= 0) & (k <= n),val,-np.inf)
+
+def match_frequencies(w_ab,w_a,w_b,w_tot):
+    w_ab,w_a,w_b = [np.asarray(v,dtype=np.float64) for v in (w_ab,w_a,w_b)]
+    w_rest = np.where(w_tot-w_ab == 0,1.,w_tot-w_ab)
+    f_a = np.where(w_tot-w_ab == 0,0.,w_a/w_rest)
+    f_b = np.where(w_tot-w_ab == 0,0.,w_b/w_rest)
+    f_ab = np.maximum(0.,1. - (1.-w_ab/w_tot)/(1-f_a*f_b))
+    return f_ab,f_a,f_b
+
+def log_instance_probabilities(w_ab,w_a,w_b,w_tot,f_a,f_b):
+    return (log_binomial(w_a+w_ab,w_tot,f_a) +
+            log_binomial(w_ab,w_a+w_ab,f_b) +
+            log_binomial(w_b,w_tot-(w_a+w_ab),f_b))
+
+def log_nonmatch_probabilities(w_ab,w_a,w_b,w_tot):
+    w_ab,w_a,w_b = [np.asarray(v,dtype=np.float64) for v in (w_ab,w_a,w_b)]
+    f_a,f_b = (w_a+w_ab)/w_tot,(w_b+w_ab)/w_tot
+    return log_instance_probabilities(w_ab,w_a,w_b,w_tot,f_a,f_b)
+
+def log_match_probabilities(w_ab,w_a,w_b,w_tot,max_terms=2**22):
+    # sums over the number of wells w explained by the pair itself, as in match_probability,
+    # with the terms for w > w_ab masked out
+    # pairs are grouped by the magnitude of w_ab so each group is only padded to its own maximum,
+    # and groups are split so at most max_terms terms are held at once
+    w_ab,w_a,w_b = np.broadcast_arrays(*[np.asarray(v,dtype=np.float64) for v in (w_ab,w_a,w_b)])
+    shape = w_ab.shape
+    w_ab,w_a,w_b = w_ab.ravel(),w_a.ravel(),w_b.ravel()
+    result = np.empty(w_ab.shape)
+
+    groups = np.ceil(np.log2(w_ab+1))
+    for g in np.unique(groups):
+        idx = np.flatnonzero(groups == g)
+        w = np.arange(int(np.max(w_ab[idx]))+1,dtype=np.float64)
+        for start in xrange(0,len(idx),max(1,max_terms/len(w))):
+            sub = idx[start:start+max(1,max_terms/len(w))]
+            n_ab,n_a,n_b = w_ab[sub,np.newaxis],w_a[sub,np.newaxis],w_b[sub,np.newaxis]
+            f_ab,f_a,f_b = match_frequencies(n_ab,n_a,n_b,w_tot)
+            terms = log_binomial(w,w_tot,f_ab) + log_instance_probabilities(n_ab-w,n_a,n_b,w_tot-w,f_a,f_b)
+            terms = np.where(w <= n_ab,terms,-np.inf)
+            with np.errstate(divide='ignore'):
+                result[sub] = scipy.special.logsumexp(terms,axis=-1)
+
+    return result.reshape(shape)
+
+# vectorized match_score; entries with w_ab == 0 score 0, as in match_score
+def match_scores(w_ab,w_a,w_b,w_tot, match_prior = 0.5):
+    w_ab,w_a,w_b = [np.asarray(v,dtype=np.float64) for v in np.broadcast_arrays(w_ab,w_a,w_b)]
+    score,f_ab = np.zeros(w_ab.shape),np.zeros(w_ab.shape)
+    nz = w_ab > 0
+    if np.any(nz):
+        mp = log_match_probabilities(w_ab[nz],w_a[nz],w_b[nz],w_tot)
+        nmp = log_nonmatch_probabilities(w_ab[nz],w_a[nz],w_b[nz],w_tot)
+        score[nz] = scipy.special.expit(mp - nmp + np.log(match_prior) - np.log(1-match_prior))
+        f_ab[nz] = match_frequencies(w_ab[nz],w_a[nz],w_b[nz],w_tot)[0]
+    return score,f_ab
+
 '''
 Specialty Calculators
 '''
@@ -104,7 +181,9 @@ def match_score(w_ab,w_a,w_b,w_tot, match_prior = 0.5):
         return (10**mp * match_prior)/(10**mp * match_prior + 10**nmp * (1-match_prior)),f_ab
 
 def possible_matches(real_matches,img_ab,a_uniques,b_uniques):
-    w_ab = np.sum(img_ab[:,:,:],axis=2)
+    # accepts either the (a x b x wells) image or (a x b) co-occurrence counts (dense or sparse)
+    if img_ab.ndim == 3: w_ab = np.sum(img_ab[:,:,:],axis=2)
+    else: w_ab = img_ab
     real = []
     for rm in real_matches:
         try: 
@@ -150,51 +229,115 @@ Returns:
         description: list of tuples (a label,b label)
         
 '''
-# TODO: reduce image dimensions to 2D
-# TODO: use sparse matrices
 # TODO: add stochasicity to well dismissal
 
 def directional_matches(img_ab,img_a,img_b,a_uniques,b_uniques,threshold=0.99,silent=False):
-    score = np.zeros((len(a_uniques),len(b_uniques)))
-    frequency = np.zeros((len(a_uniques),len(b_uniques)))
-    
+    # collapse images over the well axis, then score the resulting counts
+    w_ab = np.sum(img_ab,axis=2)
+    w_a = np.sum(img_a,axis=1)
+    w_b = np.sum(img_b,axis=1)
+    return directional_matches_counts(w_ab,w_a,w_b,img_ab.shape[2],a_uniques,b_uniques,threshold=threshold,silent=silent)
+
+'''
+
+Name: directional_matches_counts
+Function: Same as directional_matches, but works from well counts rather than images
+
+Parameters:
+    w_ab -
+        description: number of wells each pair of unique members of a and b co-occur in (dense or scipy.sparse)
+        size: (# unique a) x (# unique b)
+    w_a -
+        description: number of wells each unique member of a occurs in
+        size: (# unique a) x (1)
+    w_b -
+        description: number of wells each unique member of b occurs in
+        size: (# unique b) x (1)
+    w_tot -
+        description: total number of wells
+        size: int
+    (remaining parameters and returns as in directional_matches)
+
+'''
+
+def directional_matches_counts(w_ab,w_a,w_b,w_tot,a_uniques,b_uniques,threshold=0.99,silent=False,min_w_ab=1,min_ratio=None,chunk_size=100000):
     # important storage variables
     predicted_ab = []
     predicted_frequency = []
     predicted_score = []
-    
-    w_tot = img_ab.shape[2]
 
-    for i in xrange(img_ab.shape[0]):
+    a,b = len(a_uniques),len(b_uniques)
+    w_a,w_b = np.asarray(w_a).ravel(),np.asarray(w_b).ravel()
+
+    # only pairs that co-occur can score above 0, so only those are scored
+    cand_i,cand_j,cand_ab = candidate_pairs(w_ab,w_a,w_b,w_tot,min_w_ab=min_w_ab,min_ratio=min_ratio)
+    if not silent: print 'Scoring {} candidate pairs out of {}...\n'.format(len(cand_ab),a*b)
+
+    # per-row sum of log(1-score), for the diagnostic below
+    log_unmatched = np.zeros(a)
 
-        if not silent: print 'Starting analysis for alpha chain {}...\n'.format(a_uniques[i])
+    for start in xrange(0,len(cand_ab),chunk_size):
+        i,j = cand_i[start:start+chunk_size],cand_j[start:start+chunk_size]
 
         # create counts based on unexplained well data
-        w_ab = np.sum(img_ab[i,:,:],axis=1)
-        w_a = np.sum(img_a[i,:],axis=0)
-        w_b = np.sum(img_b[:,:],axis=1)
-
-        # assign scores
-        for j in xrange(img_ab.shape[1]):
-            n_ab = w_ab[j]
-            n_a,n_b = w_a - n_ab,w_b[j] - n_ab
-            n_tot = w_tot
-            score[i,j],frequency[i,j] = match_score(n_ab,n_a,n_b,n_tot, 1./np.sqrt(img_ab.shape[0]*img_ab.shape[1]))
-            #score[i,j],frequency[i,j] = match_score(n_ab,n_a,n_b,n_tot, 0.5) # effectively take out prior
-
-            if score[i,j] > threshold:
-              predicted_ab.append((a_uniques[i],b_uniques[j]))
-              predicted_frequency.append(frequency[i,j])
-              predicted_score.append(score[i,j])
-
-        print 'Edge detection progress... {}%\r'.format(100*(i+1)/img_ab.shape[0]),
+        n_ab = cand_ab[start:start+chunk_size]
+        n_a,n_b = w_a[i] - n_ab,w_b[j] - n_ab
+        n_tot = w_tot
+
+        # assign scores (whole chunk at once)
+        score,frequency = match_scores(n_ab,n_a,n_b,n_tot, 1./np.sqrt(a*b))
+        #score,frequency = match_scores(n_ab,n_a,n_b,n_tot, 0.5) # effectively take out prior
+
+        for k in np.flatnonzero(score > threshold):
+            predicted_ab.append((a_uniques[i[k]],b_uniques[j[k]]))
+            predicted_frequency.append(frequency[k])
+            predicted_score.append(score[k])
+
+        with np.errstate(divide='ignore'):
+            log_unmatched += np.bincount(i,weights=np.log1p(-score),minlength=a)
+
+        print 'Edge detection progress... {}%\r'.format(100*(start+len(n_ab))/len(cand_ab)),
         
     print ''
 
-    print "***", np.max([np.product(1-score[i,:]) for i in xrange(img_ab.shape[0])])
+    print "***", np.max(np.exp(log_unmatched)) if a > 0 else 1.
     
     return predicted_ab,predicted_frequency,predicted_score # returns edges
 
+'''
+
+Name: candidate_pairs
+Function: Enumerates the (a,b) pairs worth scoring, in row-major order, straight from the co-occurrence counts
+
+Parameters:
+    w_ab,w_a,w_b,w_tot -
+        description: well counts, as in directional_matches_counts
+    min_w_ab -
+        description: minimum number of co-occurring wells (1 keeps every pair that co-occurs at all)
+        size: int
+    min_ratio -
+        description: if given, minimum ratio of observed co-occurrences to those expected by chance (w_a*w_b/w_tot)
+        size: float
+Returns:
+    i,j,n_ab -
+        description: row index, column index and co-occurrence count of each candidate pair
+        size: (# candidates) x (1) each
+
+'''
+
+def candidate_pairs(w_ab,w_a,w_b,w_tot,min_w_ab=1,min_ratio=None):
+    w_ab = scipy.sparse.csr_matrix(w_ab)
+    w_ab.sort_indices()
+    w_ab = w_ab.tocoo()
+    i,j,n_ab = w_ab.row,w_ab.col,w_ab.data
+
+    keep = n_ab >= max(min_w_ab,1)
+    if min_ratio is not None:
+        w_a,w_b = np.asarray(w_a).ravel(),np.asarray(w_b).ravel()
+        keep &= n_ab >= min_ratio*w_a[i]*w_b[j]/float(w_tot)
+
+    return i[keep],j[keep],n_ab[keep]
+
 
 def reduce_graph(all_edges,all_freqs,all_scores,all_uniques):
     # implicitly assumes order of sets in: [ab,ba,aa,bb]
@@ -223,45 +366,42 @@ The Meat-and-Potatoes Function
 '''
 # Verbose: on range 0 to 9
 # TODO: verbose levels
-def solve(data,pair_threshold = 0.99,verbose=0):
+# sparse: compute well counts as a sparse product of the occupancy matrices instead of building
+#   the dense (# unique a) x (# unique b) x (# wells) image, which does not fit in memory for large plates
+# min_w_ab, min_ratio: optional pruning of candidate pairs (see candidate_pairs)
+def solve(data,pair_threshold = 0.99,verbose=0,sparse=True,min_w_ab=1,min_ratio=None):
     
     if verbose >= 5: silent = False
     else: silent = True
     
-    # find uniques
-    a_uniques = list(set([a for well in data.well_data for a in well[0]]))
-    b_uniques = list(set([b for well in data.well_data for b in well[1]]))
-
-    # sort in ascending order
-    sorted(a_uniques,key=int)
-    sorted(b_uniques,key=int)
+    # find uniques (sorted in ascending order), using the shared occupancy index
+    occupancy = data.get_occupancy()
+    a_uniques,b_uniques = occupancy.alphas,occupancy.betas
 
     # counts of each unique in wells
-    w_tot = len(data.well_data)
+    w_tot = occupancy.num_wells
 
     a,b = len(a_uniques),len(b_uniques)
     
-    img_ab = np.zeros((a,b,w_tot))
-    img_a = np.zeros((a,w_tot))
-    img_b = np.zeros((b,w_tot))
-    
+    if sparse:
+        if verbose >= 1: print 'Starting co-occurrence counts...'
 
-    if verbose >= 1: print 'Starting image creation...'
+        # well counts straight from the occupancy matrices
+        w_ab = occupancy.cooccurrence()
+        w_a,w_b = occupancy.alpha_counts,occupancy.beta_counts
+    else:
+        if verbose >= 1: print 'Starting image creation...'
     
-    # creates all the necessary images of the data
-    for w,well in enumerate(data.well_data):
-        a_ind = [a_uniques.index(i) for i in well[0]]
-        b_ind = [b_uniques.index(i) for i in well[1]]
-        a_v,b_v = np.zeros((len(a_uniques),1)),np.zeros((len(b_uniques),1)) 
-        np.put(a_v,a_ind,np.ones((len(a_ind))))
-        np.put(b_v,b_ind,np.ones((len(b_ind))))
-        # assign values to image layers
-        img_ab[:,:,w] = np.matmul(a_v,np.transpose(b_v))
-        img_a[:,w] = np.squeeze(a_v)
-        img_b[:,w] = np.squeeze(b_v)
+        # creates all the necessary images of the data
+        img_a = occupancy.alpha_wells.toarray().astype(np.float64)
+        img_b = occupancy.beta_wells.toarray().astype(np.float64)
+        img_ab = np.zeros((a,b,w_tot))
+        for w in xrange(w_tot):
+            # assign values to image layers
+            img_ab[:,:,w] = np.outer(img_a[:,w],img_b[:,w])
             
-        print 'Image generation progress... {}%\r'.format(100*(w+1)/w_tot),
-    print ''
+            print 'Image generation progress... {}%\r'.format(100*(w+1)/w_tot),
+        print ''
 
     if verbose >= 1: print 'Starting edge detection...'
             
@@ -271,8 +411,12 @@ def solve(data,pair_threshold = 0.99,verbose=0):
             
     
     # Find each type of available edge
-    ab_edges,ab_freqs,ab_scores = directional_matches(
-        img_ab,img_a,img_b,a_uniques,b_uniques,threshold=t,silent=silent)
+    if sparse:
+        ab_edges,ab_freqs,ab_scores = directional_matches_counts(
+            w_ab,w_a,w_b,w_tot,a_uniques,b_uniques,threshold=t,silent=silent,min_w_ab=min_w_ab,min_ratio=min_ratio)
+    else:
+        ab_edges,ab_freqs,ab_scores = directional_matches(
+            img_ab,img_a,img_b,a_uniques,b_uniques,threshold=t,silent=silent)
     if verbose >= 2: print 'Finished AB edges!'
         
         
@@ -281,7 +425,7 @@ def solve(data,pair_threshold = 0.99,verbose=0):
     real_matches = data.metadata['cells']
     
     # checks to see these actually occur in data
-    potential_ab_matches = possible_matches(real_matches,img_ab,a_uniques,b_uniques)
+    potential_ab_matches = possible_matches(real_matches,w_ab if sparse else img_ab,a_uniques,b_uniques)
     
     # solves for true edges
     all_edges = [ab_edges]
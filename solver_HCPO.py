@@ -1,11 +1,21 @@
+import heapq
 import math, random
 import numpy as np
 
 def extract_chains(seq_data):
-  alphas_per_well, betas_per_well = zip(*seq_data.well_data)
-  return sorted(set(sum(alphas_per_well, []))), sorted(set(sum(betas_per_well, [])))
-
-def solve(seq_data, log_epsilon_prior = None, log_m_prior = None):
+  occupancy = seq_data.get_occupancy()
+  return occupancy.alphas, occupancy.betas
+
+def _gather_rows(mat, rows):
+  # Concatenated column indices of the given rows of a CSR matrix
+  rows = np.asarray(rows, dtype=np.int64)
+  starts, ends = mat.indptr[rows], mat.indptr[rows+1]
+  lens = ends - starts
+  offsets = np.repeat(starts - (np.cumsum(lens) - lens), lens)
+  return mat.indices[offsets + np.arange(lens.sum())]
+
+def solve(seq_data, log_epsilon_prior = None, log_m_prior = None, max_new_pairs = 1):
+  # max_new_pairs bounds the number of pairs added each time a chain is processed (None for no limit)
   def compute_epsilon(N, N_a, N_ax, n):
     if N_ax==0:  return float('inf')
     if N_ax==N:  return 0.0
@@ -16,76 +26,75 @@ def solve(seq_data, log_epsilon_prior = None, log_m_prior = None):
     f_c_ax = 1-(1-f_w_ax)**(1./n)
     f_c_a = 1-(1-f_w_a)**(1./n)
     return f_c_a/f_c_ax
-  def process_alpha_chain(a_idx, pairs, done_alphas, done_betas, well_data, cells_per_well):
-    # Find existing pairs involving a_idx
-    prev_pairs = filter(lambda p: p[0]==a_idx, pairs)
-    
-    m = len(prev_pairs)
-
-    N = len(well_data)
-    wells_a, wells_ax = [],[]
-    for i,well in enumerate(well_data):
-      if a_idx not in well[0]:
-        continue
-      if any([b in well[1] for _,b in prev_pairs]):
-        wells_ax.append(i)
-      else:
-        wells_a.append(i)
+  def process_chain(x_idx, x_wells, y_wells, well_ys, partners, done_ys, N, cells_per_well):
+    # Finds new partners y for chain x, where x is an alpha- and y a beta-chain or vice versa.
+    #   x_wells, y_wells: chain x well occupancy of each side
+    #   well_ys: well x chain occupancy of the partner side
+    #   partners: partners already paired with x; done_ys: boolean mask of partner chains already processed
+    m = len(partners)
+
+    # Wells containing x are split into those explained by an existing pair (wells_ax) and the rest (wells_a)
+    wells = x_wells.indices[x_wells.indptr[x_idx]:x_wells.indptr[x_idx+1]]
+    if m > 0:
+      in_ax = np.in1d(wells, _gather_rows(y_wells, partners))
+    else:
+      in_ax = np.zeros(len(wells), dtype=bool)
+    wells_a = set(wells[~in_ax].tolist())
     N_a = len(wells_a)
-    N_ax = len(wells_ax)
+    N_ax = len(wells) - N_a
 
     cur_eps = compute_epsilon(N, N_a, N_ax, cells_per_well)
     cur_likelihood = log_epsilon_prior(cur_eps) + log_m_prior(m)
 
+    # Partner chain frequencies among wells_a, kept up to date as wells move to wells_ax,
+    # with a heap of (-count, y) entries to find the most common one (stale entries are skipped)
+    def partner_counts(wells):
+      ys = _gather_rows(well_ys, sorted(wells))
+      return np.unique(ys[~done_ys[ys]], return_counts=True)
+    ys, counts = partner_counts(wells_a)
+    y_counts = dict(zip(ys.tolist(), counts.tolist()))
+    heap = [(-c, y) for y,c in y_counts.iteritems()]
+    heapq.heapify(heap)
+
     new_pairs = []
 
     while True:
-      # Compute beta chain frequency amongs wells_a
-      b_freqs = {}
-      for well_idx in wells_a:
-        for b in well_data[well_idx][1]:
-          if b not in done_betas:
-            b_freqs[b] = b_freqs.get(b, 0) + 1
-  
-      # Get most common beta chain
-      next_b = -1
-      b_count_max = -1
-      for b,count in b_freqs.items():
-        if count > b_count_max:
-          next_b = b
-          b_count_max = count
-  
-      # If no beta chain options remained, we are done
-      if next_b==-1:
+      # Get most common partner chain (ties go to the lowest index)
+      while heap and y_counts.get(heap[0][1]) != -heap[0][0]:
+        heapq.heappop(heap)
+
+      # If no partner chain options remained, we are done
+      if not heap or len(new_pairs)==max_new_pairs:
         return new_pairs
+      y_count_max, next_y = -heap[0][0], heap[0][1]
 
       # Compute new likelihood contribution with this new pair
-      new_eps = compute_epsilon(N, N_a - b_count_max, N_ax + b_count_max, cells_per_well)
+      new_eps = compute_epsilon(N, N_a - y_count_max, N_ax + y_count_max, cells_per_well)
       new_likelihood = log_epsilon_prior(new_eps) + log_m_prior(m+1)
-  
+
       # Check if it's time to go home
       if new_likelihood <= cur_likelihood:
         return new_pairs
 
       # Otherwise, update all fields for next iter
-      new_pairs.append((a_idx, next_b))
+      new_pairs.append(next_y)
 
       cur_eps = new_eps
       m += 1
       cur_likelihood = new_likelihood
 
-      for well_idx in wells_a:
-        if next_b in well_data[well_idx]:
-          wells_ax += [well_idx]
-          wells_a.remove(well_idx)
-  def process_beta_chain(b_idx, pairs, done_alphas, done_betas, well_data, cells_per_well):
-    # Lazy, so I'm gonna just switch all alpha/beta chain data and run process_alpha_chain()
-    pairs_rev = [(b,a) for a,b in pairs]
-    well_data_rev = [[b_list, a_list] for a_list,b_list in well_data]
-    new_pairs_rev = process_alpha_chain(b_idx, pairs_rev, done_betas, done_alphas, well_data_rev, cells_per_well)
-    return [(a,b) for b,a in new_pairs_rev]
-    
-    
+      # Move the wells containing next_y to wells_ax and discount their chains
+      moved = [w for w in y_wells.indices[y_wells.indptr[next_y]:y_wells.indptr[next_y+1]].tolist() if w in wells_a]
+      wells_a.difference_update(moved)
+      N_a -= len(moved)
+      N_ax += len(moved)
+      for y,c in zip(*[v.tolist() for v in partner_counts(moved)]):
+        count = y_counts[y] - c
+        if count > 0:
+          y_counts[y] = count
+          heapq.heappush(heap, (-count, y))
+        else:
+          del y_counts[y]
 
   if log_epsilon_prior is None:
     log_epsilon_prior = lambda x: -x*5
@@ -101,19 +110,12 @@ def solve(seq_data, log_epsilon_prior = None, log_m_prior = None):
     cpw = np.mean(seq_data.metadata['cells_per_well_distribution_params']['cells_per_well'])
 
   # Extract all distinct alpha- and beta-chains observed
-  all_alphas, all_betas = extract_chains(seq_data)
-
-  # Create dictionary to look up alpha/beta index in constant time
-  alpha_to_idx = {a: i for i,a in enumerate(all_alphas)}
-  beta_to_idx = {b: i for i,b in enumerate(all_betas)}
-  # Transform all well data to reference alpha/beta chains by index
-  well_data = [[set([alpha_to_idx[a] for a in data[0]]), set([beta_to_idx[b] for b in data[1]])] for data in seq_data.well_data]
+  occupancy = seq_data.get_occupancy()
+  all_alphas, all_betas = occupancy.alphas, occupancy.betas
+  N = occupancy.num_wells
 
-  # Compute the frequency with which each alpha/beta chain appears in a well
-  alpha_counts, beta_counts = [0]*len(all_alphas), [0]*len(all_betas)
-  for well_alphas, well_betas in well_data:
-    for a in well_alphas:  alpha_counts[a] += 1
-    for b in well_betas:  beta_counts[b] += 1
+  # The frequency with which each alpha/beta chain appears in a well
+  alpha_counts, beta_counts = occupancy.alpha_counts.tolist(), occupancy.beta_counts.tolist()
 
   # Sort alpha and beta chains by frequency of occurrence
   alphas_sorted = sorted(range(len(all_alphas)), key=lambda i: -alpha_counts[i])
@@ -121,24 +123,32 @@ def solve(seq_data, log_epsilon_prior = None, log_m_prior = None):
 
   # Process the chains in order
   all_pairs = set()
-  done_alphas = set()
-  done_betas = set()
+  alpha_partners = {}
+  beta_partners = {}
+  done_alphas = np.zeros(len(all_alphas), dtype=bool)
+  done_betas = np.zeros(len(all_betas), dtype=bool)
 
   i,j = 0,0
   while i < len(alphas_sorted) or j < len(betas_sorted):
     do_alpha = j>=len(betas_sorted) or (i<len(alphas_sorted) and alpha_counts[alphas_sorted[i]]>beta_counts[betas_sorted[j]])
     if do_alpha:
       a_idx = alphas_sorted[i]
-      new_pairs = process_alpha_chain(a_idx, all_pairs, done_alphas, done_betas, well_data, cpw)
-      done_alphas.add(a_idx)
+      new_betas = process_chain(a_idx, occupancy.alpha_wells, occupancy.beta_wells, occupancy.well_betas, alpha_partners.get(a_idx, []), done_betas, N, cpw)
+      new_pairs = [(a_idx, b_idx) for b_idx in new_betas]
+      done_alphas[a_idx] = True
       #print "New pairs for alpha chain {0}:".format(a_idx), [(all_alphas[a_idx],all_betas[b_idx]) for a_idx,b_idx in new_pairs]
       i += 1
     else:
       b_idx = betas_sorted[j]
-      new_pairs = process_beta_chain(b_idx, all_pairs, done_alphas, done_betas, well_data, cpw)
-      done_betas.add(b_idx)
+      new_alphas = process_chain(b_idx, occupancy.beta_wells, occupancy.alpha_wells, occupancy.well_alphas, beta_partners.get(b_idx, []), done_alphas, N, cpw)
+      new_pairs = [(a_idx, b_idx) for a_idx in new_alphas]
+      done_betas[b_idx] = True
       #print "New pairs for beta chain {0}:".format(b_idx), [(all_alphas[a_idx],all_betas[b_idx]) for a_idx,b_idx in new_pairs]
       j += 1
-    all_pairs |= set(new_pairs)
+    for a_idx,b_idx in new_pairs:
+      if (a_idx, b_idx) not in all_pairs:
+        all_pairs.add((a_idx, b_idx))
+        alpha_partners.setdefault(a_idx, []).append(b_idx)
+        beta_partners.setdefault(b_idx, []).append(a_idx)
 
   return [(all_alphas[a_idx], all_betas[b_idx]) for a_idx,b_idx in all_pairs]
@@ -1,121 +1,374 @@
+import collections
+import math
+import multiprocessing
 import random
 import sys
 
 import itertools as it
 
 import numpy as np
-import scipy.optimize, scipy.misc, scipy.cluster
+import scipy.optimize, scipy.misc, scipy.cluster, scipy.special
 
 def extract_chains(seq_data):
-  alphas_per_well, betas_per_well = zip(*seq_data.well_data)
-  return sorted(set(sum(alphas_per_well, []))), sorted(set(sum(betas_per_well, [])))
-
-def solve(seq_data, iters=100, pair_threshold = 0.9):
+  occupancy = seq_data.get_occupancy()
+  return occupancy.alphas, occupancy.betas
+
+## Bootstrap iterations of solve()
+# Each iteration only needs the index-mapped well data, which is handed to every worker once
+# (through the pool initializer) instead of being pickled with each task
+_bootstrap_state = {}
+
+def _init_bootstrap_worker(well_data, occupancy, well_weights, all_scores, reference_assignments, well_pool = None):
+  _bootstrap_state['well_data'] = well_data
+  _bootstrap_state['occupancy'] = occupancy
+  _bootstrap_state['well_weights'] = well_weights
+  _bootstrap_state['all_scores'] = all_scores
+  _bootstrap_state['reference_assignments'] = reference_assignments
+  _bootstrap_state['well_pool'] = well_pool
+
+def association_weights(occupancy):
+  # Each well adds 1/(# alphas) + 1/(# betas) to the association score of every alpha/beta pair in it
+  # (wells missing either chain type contain no pairs, so their weight is irrelevant and set to 0)
+  na, nb = occupancy.well_alpha_counts.astype(np.float64), occupancy.well_beta_counts.astype(np.float64)
+  has_pairs = (na > 0) & (nb > 0)
+  return np.where(has_pairs, 1./np.where(has_pairs, na, 1) + 1./np.where(has_pairs, nb, 1), 0.)
+
+def association_scores(occupancy, wells_idx, well_weights, all_scores = None):
+  # Association score matrix S (sparse, alphas x betas) summed over the given wells,
+  # computed as alpha_wells * diag(well_weights) * beta_wells^T
+  # If the scores over all wells are supplied and fewer wells are left out than kept, S is
+  # obtained by removing the contributions of the left-out wells instead
+  if all_scores is not None:
+    left_out = np.setdiff1d(np.arange(occupancy.num_wells), wells_idx)
+    if len(left_out) < len(wells_idx):
+      # Round-off left by the subtraction is cleaned up in score_lookup()
+      return all_scores - occupancy.cooccurrence(left_out, well_weights[left_out])
+  return occupancy.cooccurrence(wells_idx, well_weights[wells_idx])
+
+def score_lookup(S):
+  # Flattens a CSR score matrix into sorted (row*num_cols + col) keys and their values,
+  # so that per-well submatrices can be gathered with a single searchsorted
+  # Scores are rounded here, whichever way S was computed, so that pairs that only occur in left-out
+  # wells drop out and pairs with equal scores compare equal however their sums were ordered
+  S = S.tocsr()
+  S.sort_indices()
+  rows = np.repeat(np.arange(S.shape[0], dtype=np.int64), np.diff(S.indptr))
+  vals = np.round(S.data, 10)
+  keep = vals != 0
+  return (rows*S.shape[1] + S.indices)[keep], vals[keep], S.shape[1]
+
+def score_submatrix(lookup, alpha_idx, beta_idx):
+  # Dense (len(alpha_idx) x len(beta_idx)) block of the scores; pairs absent from S score 0
+  keys, vals, num_betas = lookup
+  query = (np.asarray(alpha_idx, dtype=np.int64)[:,np.newaxis]*num_betas + np.asarray(beta_idx, dtype=np.int64)).ravel()
+  if len(keys) == 0:  return np.zeros((len(alpha_idx), len(beta_idx)))
+  pos = np.minimum(np.searchsorted(keys, query), len(keys)-1)
+  return np.where(keys[pos]==query, vals[pos], 0.).reshape(len(alpha_idx), len(beta_idx))
+
+def well_score_blocks(lookup, occupancy, wells_idx):
+  # Gathers the score submatrix of each of the given wells in one pass: the (alpha, beta) keys of
+  # every well's block are laid out with array arithmetic on the occupancy CSR arrays and looked
+  # up with a single searchsorted
+  keys, vals, num_betas = lookup
+  wells_idx = np.asarray(wells_idx, dtype=np.int64)
+  na, nb = occupancy.well_alpha_counts[wells_idx], occupancy.well_beta_counts[wells_idx]
+  sizes = na*nb
+  block_id = np.repeat(np.arange(len(wells_idx)), sizes)
+  offset = np.arange(np.sum(sizes)) - np.repeat(np.cumsum(sizes)-sizes, sizes)
+  rows, cols = offset // np.maximum(nb[block_id], 1), offset % np.maximum(nb[block_id], 1)
+  alpha_idx = occupancy.well_alphas.indices[occupancy.well_alphas.indptr[wells_idx][block_id] + rows]
+  beta_idx = occupancy.well_betas.indices[occupancy.well_betas.indptr[wells_idx][block_id] + cols]
+  query = alpha_idx.astype(np.int64)*num_betas + beta_idx
+
+  if len(keys) == 0:
+    block_vals = np.zeros(len(query))
+  else:
+    pos = np.minimum(np.searchsorted(keys, query), len(keys)-1)
+    block_vals = np.where(keys[pos]==query, vals[pos], 0.)
+  return [v.reshape(r, c) for v,r,c in zip(np.split(block_vals, np.cumsum(sizes)[:-1]), na, nb)]
+
+def _solve_assignment(block):
+  # Maximum-score assignment of rows to columns of a single score block, as (row, col) index arrays
+  if block.shape[0]==0 or block.shape[1]==0:  return np.zeros(0, dtype=int), np.zeros(0, dtype=int) # scipy hungarian implementation doesn't handle this edge case
+  return scipy.optimize.linear_sum_assignment(-block)
+
+def assignment_potentials(block, rows, cols, start = None, max_rounds = None, tol = 1e-9):
+  # Row potentials certifying that the assignment (rows, cols) is a maximum-score assignment of the block,
+  # or None if it is not (or if none were found within max_rounds Bellman-Ford rounds).
+  # The block is padded to a square with zero scores, unassigned rows/columns are paired off, and the
+  # assignment is optimal iff no cycle of reassignments lowers the cost (-score), i.e. iff potentials
+  # exist; these are found with a vectorized Bellman-Ford over the rows. Starting it from the potentials
+  # of a similar block (start) makes it stop after a few rounds when they need little adjustment; without
+  # a round limit, a non-optimal assignment always takes the full n rounds
+  n = max(block.shape)
+  if n == 0:  return np.zeros(0)
+  cost = np.zeros((n, n))
+  cost[:block.shape[0], :block.shape[1]] = -block
+  match = np.zeros(n, dtype=np.int64)
+  match[rows] = cols
+  match[np.setdiff1d(np.arange(n), rows)] = np.setdiff1d(np.arange(n), cols)
+
+  # Moving along i -> k, row i takes row k's column: the cost changes by cost[i,match[k]] - cost[k,match[k]]
+  D = cost[:, match] - cost[np.arange(n), match][np.newaxis, :]
+  dist = np.zeros(n) if start is None else np.array(start, dtype=np.float64)
+  for _ in range(n if max_rounds is None else min(n, max_rounds)):
+    new_dist = np.minimum(dist, np.min(dist[:, np.newaxis] + D, axis=0))
+    if np.all(new_dist > dist - tol):  return dist
+    dist = new_dist
+  return None
+
+def certify_assignment(block, rows, cols, potentials = None, max_rounds = 8, tol = 1e-9):
+  # True if the assignment (rows, cols) is certified to still be a maximum-score assignment of the block
+  # Starting from the potentials of the reference block, certified assignments need only a few rounds, so
+  # the search gives up after max_rounds (O(max_rounds n^2) per well); a well that is not certified is solved
+  return assignment_potentials(block, rows, cols, potentials, max_rounds, tol) is not None
+
+def solve_well_assignments(blocks, pool = None, chunksize = 64):
+  # Solves a batch of per-well assignment problems, optionally dispatching them in chunks to a
+  # multiprocessing pool (used by solve() when there are fewer iterations than jobs)
+  if pool is not None:
+    return pool.map(_solve_assignment, blocks, chunksize)
+  return [_solve_assignment(block) for block in blocks]
+
+def compute_well_pairings(alpha_idx, beta_idx, scores):
+
+  if len(alpha_idx)==0 or len(beta_idx)==0:  return [] # scipy hungarian implementation doesn't handle this edge case
+
+  # Reformulate problem as a general assignment problem
+  # Then apply Hungarian algorithm
+  # Indices in the results of running Hungarian are transformed back into alpha/beta chain ids
+  ratings = -score_submatrix(scores, alpha_idx, beta_idx)
+  pairings = [(alpha_idx[i], beta_idx[j]) for i,j in zip(*scipy.optimize.linear_sum_assignment(ratings))]
+
+  return pairings
+
+def _bootstrap_iteration(args):
+  # Runs a single bootstrap iteration and returns the pairs exceeding that iteration's cutoff
+  # The iteration draws its wells from its own RandomState, seeded by (seed, iter), so the result
+  # does not depend on which process runs it or in what order
+  seed, iter = args
+  well_data = _bootstrap_state['well_data']
+  occupancy = _bootstrap_state['occupancy']
+  rand = np.random.RandomState([seed, iter])
+
+  # Choose random subset of wells for this iter
+  # Loop is to ensure that subset size is greater than 0 (can happen w/ small well count)
+  #wells_idx = []
+  #while len(wells_idx)==0:  wells_idx = [i for i in range(len(well_data)) if random.random()>0.5]
+  # Actually, each random subset is constant fraction (0.75) of all wells
+  wells_idx = rand.choice(len(well_data), int(0.75*len(well_data)), replace=False)
+  
+  # Calculate association scores
+  S = association_scores(occupancy, wells_idx, _bootstrap_state['well_weights'], _bootstrap_state['all_scores'])
+  S = score_lookup(S)
+
+  # Compute well pairings for any well, if it hasn't been done already
+  # Each well first tries its reference assignment (solved once on the scores over all wells), which
+  # is used whenever it is certified to still be optimal; the remaining wells are solved as one batch.
+  # This does not depend on which iterations a process has run before, so results do not depend on n_jobs.
+  references = _bootstrap_state['reference_assignments']
+  cache_stats = {'certified_hits': 0, 'misses': 0}
+  blocks = well_score_blocks(S, occupancy, wells_idx)
+  solutions = [None]*len(wells_idx)
+  unsolved = []
+  for idx, (well_idx, block) in enumerate(zip(wells_idx, blocks)):
+    if references is not None:
+      rows, cols, potentials = references[well_idx]
+      if certify_assignment(block, rows, cols, potentials):
+        solutions[idx] = (rows, cols)
+        cache_stats['certified_hits'] += 1
+        continue
+    unsolved.append(idx)
+    cache_stats['misses'] += 1
+  for idx, solution in zip(unsolved, solve_well_assignments([blocks[idx] for idx in unsolved], _bootstrap_state['well_pool'])):
+    solutions[idx] = solution
+
+  # Then accumulate the number of times each pair has been assigned in a well pairing
+  # Indices in the assignments are transformed back into alpha/beta chain indices
+  pairing_counts = {}
+  for well_idx, solution in zip(wells_idx, solutions):
+    well_alpha_idx, well_beta_idx = well_data[well_idx]
+    for i,j in zip(*solution):
+      a,b = well_alpha_idx[i], well_beta_idx[j]
+      pairing_counts[(a,b)] = pairing_counts.get((a,b), 0) + 1
+
+  # Compute filter cutoff (average of all nonzero pair counts)
+  cutoff = np.mean(pairing_counts.values())
+
+  # Extract all pairs with counts exceeding the cutoff
+  return [pair for pair in pairing_counts if pairing_counts[pair]>cutoff], cache_stats
+
+def solve(seq_data, iters=100, pair_threshold = 0.9, n_jobs = 1, seed = None, memoize = True, find_duals = False):
   ## Computes a solution to the alpha-beta pairing problem, using the methods in Lee et al. (2017)
-  def compute_well_pairings(alpha_idx, beta_idx, scores):
-
-    if len(alpha_idx)==0 or len(beta_idx)==0:  return [] # scipy hungarian implementation doesn't handle this edge case
-
-    # Reformulate problem as a general assignment problem
-    # Then apply Hungarian algorithm
-    # Indices in the results of running Hungarian are transformed back into alpha/beta chain ids
-    ratings = [[-scores[i][j] for j in beta_idx] for i in alpha_idx]
-    pairings = [(alpha_idx[i], beta_idx[j]) for i,j in zip(*scipy.optimize.linear_sum_assignment(ratings))]
-
-    return pairings
+  ## Bootstrap iterations are spread over n_jobs processes (-1 uses every core); with fewer iterations
+  ## than jobs, the iterations run in this process and their per-well assignments are spread instead
+  ## For a given seed the output is identical regardless of n_jobs; if no seed is given, one is
+  ## drawn from np.random so that seeding numpy's global state still makes runs reproducible
+  ## memoize: reuse per-well assignments across iterations where they are certified to still be optimal
+  ## (hit counts are returned in results['assignment_cache_stats']). Among equally good assignments the
+  ## reused one may differ from the one a fresh solve would pick, so turn this off to reproduce old runs
+  ## find_duals: merge pairs that share a beta-chain into dual-alpha cells where the data supports it
+  ## Cell frequencies are estimated with the vectorized estimate_cell_frequencies(), which computes Q in
+  ## closed form; Q_cache only serves estimate_cell_frequencies(vectorized=False) and is not used here
   
   # Extract all distinct alpha- and beta-chains observed
   # TODO: might be better to extract the chains directly from the cells in the system
-  all_alphas, all_betas = extract_chains(seq_data)
+  occupancy = seq_data.get_occupancy()
+  all_alphas, all_betas = occupancy.alphas, occupancy.betas
   
-  # Create dictionary to look up alpha/beta index in constant time
-  alpha_to_idx = {a: i for i,a in enumerate(all_alphas)}
-  beta_to_idx = {b: i for i,b in enumerate(all_betas)}
-  # Transform all well data to reference alpha- and beta-chains by index
-  well_data = [[[alpha_to_idx[a] for a in data[0]], [beta_to_idx[b] for b in data[1]]] for data in seq_data.well_data]
-
+  # Well data referencing alpha- and beta-chains by index, taken from the shared occupancy index
+  well_data = [[occupancy.well_alpha_idx(w).tolist(), occupancy.well_beta_idx(w).tolist()] for w in range(occupancy.num_wells)]
+
+  if seed is None:  seed = np.random.randint(2**31)
+  if n_jobs == -1:  n_jobs = multiprocessing.cpu_count()
+
+  # Run the iterations, in process or across a pool of workers
+  # With fewer iterations than jobs the pool would sit mostly idle, so the iterations run in process
+  # and each one hands its batch of per-well assignment problems to the pool instead
+  # Results come back in iteration order either way
+  # Association scores over all wells are computed once; each iteration then only removes
+  # the contributions of the wells it leaves out
+  well_weights = association_weights(occupancy)
+  all_scores = occupancy.cooccurrence(well_weights=well_weights)
+  # Reference assignment of every well, which most iterations can reuse (see _bootstrap_iteration)
+  all_wells_idx = np.arange(occupancy.num_wells)
+  well_pool = multiprocessing.Pool(n_jobs) if 1 < n_jobs and iters < n_jobs else None
+  if memoize:
+    reference_blocks = well_score_blocks(score_lookup(all_scores), occupancy, all_wells_idx)
+    reference_assignments = [(rows, cols, assignment_potentials(block, rows, cols))
+      for block, (rows, cols) in zip(reference_blocks, solve_well_assignments(reference_blocks, well_pool))]
+  else:
+    reference_assignments = None
+  worker_args = (well_data, occupancy, well_weights, all_scores, reference_assignments)
+  iter_args = [(seed, iter) for iter in range(iters)]
+  if n_jobs > 1 and well_pool is None:
+    pool = multiprocessing.Pool(n_jobs, initializer=_init_bootstrap_worker, initargs=worker_args)
+    iter_results = pool.imap(_bootstrap_iteration, iter_args)
+  else:
+    pool = well_pool
+    _init_bootstrap_worker(*(worker_args + (well_pool,)))
+    iter_results = it.imap(_bootstrap_iteration, iter_args)
 
   overall_pairing_counts = {}
-  for iter in range(iters):
-    # Choose random subset of wells for this iter
-    # Loop is to ensure that subset size is greater than 0 (can happen w/ small well count)
-    #wells_idx = []
-    #while len(wells_idx)==0:  wells_idx = [i for i in range(len(well_data)) if random.random()>0.5]
-    # Actually, each random subset is constant fraction (0.75) of all wells
-    wells_idx = np.random.choice(range(len(well_data)), int(0.75*len(well_data)), replace=False)
-    
-    # Calculate association scores
-    S = [[0 for j in range(len(all_betas))] for i in range(len(all_alphas))]
-    for well_idx in wells_idx:
-      well_alpha_idx, well_beta_idx = well_data[well_idx]
-      for a_idx in well_alpha_idx:
-        for b_idx in well_beta_idx:
-          increment = 1./len(well_alpha_idx) + 1./len(well_beta_idx)
-          S[a_idx][b_idx] += increment
-
-    # Compute well pairings for any well, if it hasn't been done already
-    # Then accumulate the number of times each pair has been assigned in a well pairing
-    pairing_counts = {}
-    for idx, well_idx in enumerate(wells_idx):
-      well_pairings = compute_well_pairings(*well_data[well_idx], scores=S)
-      #print "Computing likely pairings... {0}%\r".format(int(100*((iter+1) + float(idx)/len(wells_idx))/iters)),
-      for a,b in well_pairings:
-        pairing_counts[(a,b)] = pairing_counts.get((a,b), 0) + 1
-
-    # Compute filter cutoff (average of all nonzero pair counts)
-    cutoff = np.mean(pairing_counts.values())
-
-    # Extract all pairs with counts exceeding the cutoff
-    good_pairs = [pair for pair in pairing_counts if pairing_counts[pair]>cutoff]
-
-    # For each pair exceeding the cutoff, increment the overall_pairing_counts number
-    for pair in good_pairs:
-      overall_pairing_counts[pair] = overall_pairing_counts.get(pair, 0) + 1
-
-    print "Computing likely pairings... {0}%\r".format(100*(iter+1)/iters),
-    sys.stdout.flush()
+  cache_stats = {'certified_hits': 0, 'misses': 0}
+  try:
+    for iter, (good_pairs, iter_cache_stats) in enumerate(iter_results):
+      for k in cache_stats:  cache_stats[k] += iter_cache_stats[k]
+
+      # For each pair exceeding the cutoff, increment the overall_pairing_counts number
+      for pair in good_pairs:
+        overall_pairing_counts[pair] = overall_pairing_counts.get(pair, 0) + 1
+
+      print "Computing likely pairings... {0}%\r".format(100*(iter+1)/iters),
+      sys.stdout.flush()
+  finally:
+    # The in-process state holds the per-well pool (if any); drop it with the pool so a later solve()
+    # never sees a closed pool, even if an iteration raised
+    if pool is not None:
+      pool.close()
+      pool.join()
+    _bootstrap_state.clear()
 
   overall_good_pairs = [pair for pair in overall_pairing_counts if overall_pairing_counts[pair]>=pair_threshold*iters]
 
   pairs = [(all_alphas[a], all_betas[b]) for a,b in overall_good_pairs]
 
   # Turns pairs of associated alpha- and beta- chains into cells that may have dual alpha chains
-  cells, cell_freqs, cell_freqs_CI = pairs_to_cells(seq_data, pairs) 
+  cells, cell_freqs, cell_freqs_CI = pairs_to_cells(seq_data, pairs, find_duals=find_duals) 
 
   thresholds = [overall_pairing_counts[p]/float(iters) for p in overall_good_pairs]
 
+  num_lookups = sum(cache_stats.values())
+  cache_stats['hit_rate'] = float(cache_stats['certified_hits'])/num_lookups if num_lookups>0 else float('nan')
+
   results = {
     'cells': cells,
     'cell_frequencies': cell_freqs,
     'cell_frequencies_CI': cell_freqs_CI,
-    'cell_thresholds': thresholds
+    'cell_thresholds': thresholds,
+    'assignment_cache_stats': cache_stats
   }
 
   return results
 
-def estimate_cell_frequencies(seq_data, cells):
-
-  def log_likelihood_func(f, N, W, K, Q_memo = {}, error_rate=0.15, is_dual=False):
+## Q vectors for the scalar likelihood in estimate_cell_frequencies()
+def compute_Q(f, N, error_rate=0.15, is_dual=False):
+  # Q vector of Eq (3) in Lee et al.: probability, for each well size n in N, that a cell with
+  # frequency f does not show up in a well of that size (it is absent, or its chains drop out)
+  if not is_dual:
+    prefactor = lambda m: 2*error_rate**m - error_rate**(2*m)
+  else:
+    prefactor = lambda m: 3*error_rate**m - 3*error_rate**(2*m) + error_rate**(3*m)
+  Q = []
+  for n in N:
+    q = (1-f)**n + sum([
+        prefactor(m) * scipy.misc.comb(n,m) * (f**m) * (1-f)**(n-m) 
+    for m in range(1, n+1)])
+    Q.append(q)
+  return Q
+
+class QCache(object):
+  """ Bounded, least-recently-used cache of Q vectors, shared by all solves in a process.
+  Q is stored on a log-spaced grid of frequencies (points_per_decade grid points per factor of 10)
+  and linearly interpolated between grid points, so that nearby f's evaluated by the optimizer share
+  entries instead of each adding a new one. f = 0 and f >= 1 are stored exactly.
+  Only the scalar path, estimate_cell_frequencies(vectorized=False), goes through the cache; the default
+  vectorized path evaluates Q in closed form for all cells at once and never looks it up.
+    - max_size: maximum number of Q vectors held; the least recently used are evicted past this
+    - stats(): hit, miss and eviction counts and current size
+    - clear(): empties the cache and resets the counts
+  """
+
+  def __init__(self, max_size = 20000, points_per_decade = 2000):
+    self.max_size = max_size
+    self.points_per_decade = points_per_decade
+    self.clear()
+
+  def clear(self):
+    self._entries = collections.OrderedDict()
+    self.hits, self.misses, self.evictions = 0, 0, 0
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._entries)}
+
+  def _lookup(self, f, grid_idx, N, error_rate, is_dual):
+    key = (tuple(N), error_rate, is_dual, grid_idx if grid_idx is not None else f)
+    if key in self._entries:
+      self.hits += 1
+      Q = self._entries.pop(key)
+    else:
+      self.misses += 1
+      Q = compute_Q(f, N, error_rate, is_dual)
+      if len(self._entries) >= self.max_size:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+    self._entries[key] = Q
+    return Q
+
+  def get_Q(self, f, N, error_rate = 0.15, is_dual = False):
+    if f <= 0 or f >= 1:
+      return self._lookup(f, None, N, error_rate, is_dual)
+    x = math.log10(f)*self.points_per_decade
+    i = int(math.floor(x))
+    t = x - i
+    Q_lo = self._lookup(10**(float(i)/self.points_per_decade), i, N, error_rate, is_dual)
+    if t == 0:  return Q_lo
+    Q_hi = self._lookup(10**(float(i+1)/self.points_per_decade), i+1, N, error_rate, is_dual)
+    return [(1-t)*q_lo + t*q_hi for q_lo,q_hi in zip(Q_lo, Q_hi)]
+
+Q_cache = QCache()
+
+def estimate_cell_frequencies(seq_data, cells, vectorized = True):
+  ## Maximum-likelihood frequency and 95% CI of each cell (Lee et al., Eqs (3) and (4))
+  ## vectorized: estimate all cells at once with estimate_cell_frequencies_batch() rather than
+  ## running three bounded scalar optimizations per cell (only the latter uses Q_cache)
+
+  def log_likelihood_func(f, N, W, K, error_rate=0.15, is_dual=False):
     # Note: See Eqs (3) and (4) in Lee et al. for explanation of variables
   
-    # Compute Q vector if not previously computed
-    Q_key = (tuple(N), tuple(W), error_rate, f, is_dual)
-    if Q_key not in Q_memo:
-      Q = []
-      if not is_dual:
-        prefactor = lambda m: 2*error_rate**m - error_rate**(2*m)
-      else:
-        prefactor = lambda m: 3*error_rate**m - 3*error_rate**(2*m) + error_rate**(3*m)
-      for n,w in zip(N,W):
-        q = (1-f)**n + sum([
-            prefactor(m) * scipy.misc.comb(n,m) * (f**m) * (1-f)**(n-m) 
-        for m in range(1, n+1)])
-        Q.append(q)
-      Q_memo[Q_key] = Q
-  
-    # Retrieve Q from memoized dict of Q's
-    # Note that Q only depends on N, W, error_rate, f, and is_dual
-    Q = Q_memo[Q_key]
+    # Retrieve Q from the shared cache of Q's
+    # Note that Q only depends on N, error_rate, f, and is_dual
+    Q = Q_cache.get_Q(f, N, error_rate, is_dual)
   
     # Compute log likelihood as sum of Binomial probabilities
     # Note that the "combinations" in the binomial PDF is ignored as it does not affect
@@ -126,6 +379,10 @@ def estimate_cell_frequencies(seq_data, cells):
 
   K = extract_cell_counts(seq_data, cells, cells_per_well, N, W)
 
+  if vectorized:
+    freqs, freqs_min, freqs_max = estimate_cell_frequencies_batch(N, W, K, [len(alist)>1 for alist,_ in cells])
+    return freqs.tolist(), zip(freqs_min.tolist(), freqs_max.tolist())
+
   cell_freqs = []
   cell_freq_CIs = []
   for (alist, blist), k in zip(cells, K):
@@ -146,114 +403,202 @@ def estimate_cell_frequencies(seq_data, cells):
   
   return cell_freqs, cell_freq_CIs
 
-def pairs_to_cells(seq_data, pairs):
-  def find_duals_likelihood(candidate_duals, freqs_dict, well_size_cutoff = 50, error_rate=0.15):
-    cells_per_well, N, W = extract_cells_per_well(seq_data)
+## Vectorized frequency estimation, used by estimate_cell_frequencies()
+def log_Q(f, N, error_rate=0.15, is_dual=False):
+  # Returns log(q) and log(1-q) for every f (any shape) and every well size n in N, with shape f.shape + (len(N),)
+  # Uses the closed form of the sum in Eq (3): sum_m C(n,m) f^m (1-f)^(n-m) e^(p*m) = (1 - f*(1-e^p))^n,
+  # so q = 2(1-f(1-e))^n - (1-f(1-e^2))^n (or 3,-3,1 with e,e^2,e^3 for dual cells)
+  # 1-q is computed with expm1 so it stays accurate when f is small and q is close to 1
+  coefs = [(3,1), (-3,2), (1,3)] if is_dual else [(2,1), (-1,2)]
+  f = np.asarray(f, dtype=np.float64)[..., np.newaxis]
+  n = np.asarray(N, dtype=np.float64)
+  x = [n*np.log1p(-f*(1-error_rate**p)) for _,p in coefs]
+  q = sum([c*np.exp(x_p) for (c,_),x_p in zip(coefs, x)])
+  one_minus_q = -sum([c*np.expm1(x_p) for (c,_),x_p in zip(coefs, x)])
+  with np.errstate(divide='ignore'):
+    return np.log(q), np.log(np.maximum(one_minus_q, 0.))
+
+def _log_likelihoods(f, N, W, K, is_dual, error_rate):
+  # Log likelihood of each cell (rows of K) at its own frequency f (same length as K), dropping the
+  # constant binomial coefficients; 0*log(0) terms are taken to be 0
+  L = np.zeros(len(K))
+  for dual in (False, True):
+    rows = np.flatnonzero(is_dual == dual)
+    if len(rows) == 0:  continue
+    log_q, log_1mq = log_Q(f[rows], N, error_rate=error_rate, is_dual=dual)
+    with np.errstate(invalid='ignore'):
+      terms = np.where(K[rows]>0, K[rows]*log_1mq, 0.) + np.where(W-K[rows]>0, (W-K[rows])*log_q, 0.)
+    L[rows] = np.sum(terms, axis=1)
+  return L
+
+def estimate_cell_frequencies_batch(N, W, K, is_dual, error_rate=0.15, grid_size=400, iters=60):
+  # Frequency MLE and 95% CI bounds (where the log likelihood has dropped by 1.96) for all cells at once
+  # N, W: distinct well sizes and the number of wells of each size; K: (cells x len(N)) counts of wells
+  # containing each cell; is_dual: whether each cell has two alpha chains
+  #  1. the likelihood of every cell is evaluated on a shared log-spaced frequency grid, reusing one
+  #     Q per grid point for all cells
+  #  2. each cell's MLE is refined by golden-section search between the neighbours of its best grid point
+  #  3. the CI bounds are found by bisection on [0, f_opt] and [f_opt, 1]
+  # Each refinement step evaluates every cell at once
+  W = np.asarray(W, dtype=np.float64)
+  K = np.asarray(K, dtype=np.float64).reshape(-1, len(W))
+  is_dual = np.asarray(is_dual, dtype=bool)
+  L = lambda f: _log_likelihoods(f, N, W, K, is_dual, error_rate)
+
+  # 1. Shared grid
+  grid = np.concatenate([[0.], np.logspace(-8, 0, grid_size)])
+  L_grid = np.zeros((len(K), len(grid)))
+  for dual in (False, True):
+    rows = np.flatnonzero(is_dual == dual)
+    if len(rows) == 0:  continue
+    log_q, log_1mq = log_Q(grid, N, error_rate=error_rate, is_dual=dual)
+    # Clip -inf logs (f=0) so that cells with zero counts contribute 0 rather than nan
+    log_q, log_1mq = np.maximum(log_q, -1e300), np.maximum(log_1mq, -1e300)
+    with np.errstate(over='ignore', invalid='ignore'):
+      L_grid[rows] = np.dot(K[rows], log_1mq.T) + np.dot(W-K[rows], log_q.T)
+  best = np.argmax(L_grid, axis=1)
+
+  # 2. Golden-section search for the maximum
+  ratio = (np.sqrt(5)-1)/2
+  lo, hi = grid[np.maximum(best-1, 0)], grid[np.minimum(best+1, len(grid)-1)]
+  for _ in range(iters):
+    m1, m2 = hi - ratio*(hi-lo), lo + ratio*(hi-lo)
+    go_left = L(m1) > L(m2)
+    lo, hi = np.where(go_left, lo, m1), np.where(go_left, m2, hi)
+  f_opt = (lo+hi)/2
+  L_cutoff = L(f_opt) - 1.96
+
+  # 3. Bisection for the points where the likelihood crosses L_cutoff
+  # (if it never does, the bound ends up at 0 or 1)
+  lo, hi = np.zeros(len(K)), f_opt.copy()
+  for _ in range(iters):
+    mid = (lo+hi)/2
+    above = L(mid) >= L_cutoff
+    lo, hi = np.where(above, lo, mid), np.where(above, mid, hi)
+  f_min = (lo+hi)/2
+
+  lo, hi = f_opt.copy(), np.ones(len(K))
+  for _ in range(iters):
+    mid = (lo+hi)/2
+    above = L(mid) >= L_cutoff
+    lo, hi = np.where(above, mid, lo), np.where(above, hi, mid)
+  f_max = (lo+hi)/2
+
+  return f_opt, f_min, f_max
+
+## Dual-alpha likelihood test, used by pairs_to_cells()
+def dual_log_tables(n, error_rate=0.15):
+  # Tables for the dual-clone likelihoods of Lee et al. (SI, Section 5) in wells of n cells, built once per well size
+  # Each probability is a sum over the number of cells of each clone in the well: single sums over k = 1..n cells of
+  # one clone, and double sums over n_1, n_2 >= 1 cells of two clones (n_1 + n_2 <= n). For each sum the table holds
+  #   - X: (terms x 3) exponents of (first clone freq, second clone freq, freq of everything else)
+  #   - log weights: log multinomial coefficient plus the log probability of the chain dropouts for that term
+  # so that the sum for frequencies f is logsumexp(dot(log f, X.T) + weights)
+  e = error_rate
+  log_fact = lambda x: scipy.special.gammaln(np.asarray(x, dtype=np.float64)+1)
+
+  k = np.arange(1, n+1)
+  X_single = np.column_stack([k, np.zeros_like(k), n-k])
+  log_binom = log_fact(n) - log_fact(k) - log_fact(n-k)
+  e_k = e**k.astype(np.float64)
+
+  n_1, n_2 = [v.ravel() for v in np.meshgrid(k, k, indexing='ij')]
+  n_1, n_2 = n_1[n_1+n_2 <= n], n_2[n_1+n_2 <= n]
+  X_double = np.column_stack([n_1, n_2, n-n_1-n_2])
+  log_multinom = log_fact(n) - log_fact(n_1) - log_fact(n_2) - log_fact(n-n_1-n_2)
+  e_1, e_2 = e**n_1.astype(np.float64), e**n_2.astype(np.float64)
+
+  with np.errstate(divide='ignore'):
+    return {
+      'X_single': X_single,
+      'X_double': X_double,
+      # Null hypothesis (first clone a1b/a2b, second clone the other one)
+      'first_ab': log_binom + 2*np.log1p(-e_k),
+      'both_ab': log_multinom + np.log((1-e_1)**2*e_2 + (1-e_1)*e_1*(1-e_2)*e_2),
+      'both_aa': log_multinom + np.log(e_1*(1-e_1)*e_2*(1-e_2)),
+      'both_aab': log_multinom + np.log(e_1*(1-e_1)*(1-e_2)**2 + (1-e_1)**2*(1-e_2)**2 + (1-e_1)**2*e_2*(1-e_2)),
+      # Alternative hypothesis (one dual clone a1a2b)
+      'dual_2': log_binom + k*np.log(e) + 2*np.log1p(-e_k),
+      'dual_3': log_binom + 3*np.log1p(-e_k),
+    }
+
+def _log_sum_terms(log_f, X, log_weights, max_terms):
+  # logsumexp over the terms of one table for each row of log_f, holding at most max_terms terms at once
+  result = np.empty(len(log_f))
+  if len(X) == 0:
+    result[:] = -np.inf
+    return result
+  step = max(1, max_terms/len(X))
+  for start in xrange(0, len(log_f), step):
+    terms = np.dot(log_f[start:start+step], X.T) + log_weights
+    result[start:start+step] = scipy.special.logsumexp(terms, axis=1)
+  return result
+
+def dual_log_likelihood_ratios(N, W, K, f_q, f_r, f_d, error_rate=0.15, max_terms=2**22):
+  # Log likelihood ratio (alternative minus null) of every candidate dual cell a1a2b at once
+  # N, W: distinct well sizes and number of wells of each size
+  # K: (candidates x 4 x len(N)) well counts of the cells a1b, a2b, a1a2 and a1a2b
+  # f_q, f_r, f_d: estimated frequencies of a1b, a2b and a1a2b
+  # The multinomial coefficients of the well counts are the same under both hypotheses and are dropped
+  K = np.asarray(K, dtype=np.float64).reshape(-1, 4, len(N))
+  K_o = np.asarray(W, dtype=np.float64) - K.sum(axis=1)
+  clip_log = lambda x: np.maximum(np.log(np.maximum(x, 0.)), -1e300)
+  f_q, f_r, f_d = [np.asarray(f, dtype=np.float64) for f in (f_q, f_r, f_d)]
+  log_f = np.column_stack([clip_log(f_q), clip_log(f_r), clip_log(1-f_q-f_r)])
+  log_f_swap = log_f[:, [1,0,2]]
+  log_f_d = np.column_stack([clip_log(f_d), np.zeros_like(f_d), clip_log(1-f_d)])
+
+  def multinomial_terms(k, log_p):
+    # sum of k*log(p), with 0*log(0) taken to be 0
+    with np.errstate(invalid='ignore'):
+      return np.where(k>0, k*log_p, 0.)
+
+  ratios = np.zeros(len(K))
+  for j,n in enumerate(N):
+    T = dual_log_tables(n, error_rate)
+    lse = lambda lf, X, weights: _log_sum_terms(lf, T[X], T[weights], max_terms)
+
+    null_log_P = [
+      np.logaddexp(lse(log_f, 'X_single', 'first_ab'), lse(log_f, 'X_double', 'both_ab')),
+      np.logaddexp(lse(log_f_swap, 'X_single', 'first_ab'), lse(log_f_swap, 'X_double', 'both_ab')),
+      lse(log_f, 'X_double', 'both_aa'),
+      lse(log_f, 'X_double', 'both_aab')
+    ]
+    alt_log_P2 = lse(log_f_d, 'X_single', 'dual_2')
+    alt_log_P3 = lse(log_f_d, 'X_single', 'dual_3')
+    alt_log_P = [alt_log_P2, alt_log_P2, alt_log_P2, alt_log_P3]
+
+    with np.errstate(divide='ignore'):
+      null_log_Po = np.log(np.maximum(1 - sum([np.exp(lp) for lp in null_log_P]), 0.))
+      alt_log_Po = np.log(np.maximum(1 - 3*np.exp(alt_log_P2) - np.exp(alt_log_P3), 0.))
+
+    for i in range(4):
+      ratios += multinomial_terms(K[:,i,j], alt_log_P[i]) - multinomial_terms(K[:,i,j], null_log_P[i])
+    ratios += multinomial_terms(K_o[:,j], alt_log_Po) - multinomial_terms(K_o[:,j], null_log_Po)
+
+  return ratios
+
+def pairs_to_cells(seq_data, pairs, find_duals = False):
+  ## find_duals: look for dual-alpha cells among pairs sharing a beta-chain (likelihood and clustering tests)
+  def find_duals_likelihood(candidate_duals, freqs_dict, well_size_cutoff = None, error_rate=0.15, threshold=10):
+    # Likelihood ratio test of Lee et al. (SI, Section 5), run on all candidates at once by dual_log_likelihood_ratios()
+    # Well sizes >= well_size_cutoff (if given) are left out of the test
+    if len(candidate_duals) == 0:
+      return []
 
-    duals = []
-    for alist, blist in candidate_duals:
-      cells_temp = [((alist[0],), blist), ((alist[1],), blist), (alist, ()), (alist, blist)]
-      #print "", cells_temp
-      K = extract_cell_counts(seq_data, cells_temp, cells_per_well, N, W)
-      #print "", K
-
-      # Extract individual cell counts (see Lee et al., SI, Section 5 for explanation of variables)
-      K_1 = K[0]
-      K_2 = K[1]
-      K_3 = K[2]
-      K_d = K[3]
-      K_o = [w-k1-k2-k3-kd for w,k1,k2,k3,kd in zip(W, K_1, K_2, K_3, K_d)]
-
-      # Extract relevant cell frequencies
-      f_q = freqs_dict[cells_temp[0]]
-      f_r = freqs_dict[cells_temp[1]]
-      f_d = freqs_dict[cells_temp[3]]
-
-      # Null hypothesis (no dual clone)
-      log_fact = lambda x: scipy.special.gammaln(x+1)
-
-      # disgusting calculations
-      null_P_a1b = [
-        sum([
-          scipy.misc.comb(n, k) * f_q**k * (1-f_q-f_r)**(n-k) * (1-error_rate**k)**2
-          for k in range(1, n+1)
-        ]) +
-        sum([
-          np.exp(log_fact(n) - log_fact(n_1) - log_fact(n_2) - log_fact(n-n_1-n_2) + n_1*np.log(f_q) + n_2*np.log(f_r) + (n-n_1-n_2)*np.log(1-f_q-f_r) + 2*np.log(1-error_rate**n_1) + n_2*np.log(error_rate))
-          for n_1 in range(1, n) for n_2 in range(1, n-n_1+1)
-        ]) +
-        sum([
-          np.exp(log_fact(n) - log_fact(n_1) - log_fact(n_2) - log_fact(n-n_1-n_2) + n_1*np.log(f_q) + n_2*np.log(f_r) + (n-n_1-n_2)*np.log(1-f_q-f_r) + np.log(1-error_rate**n_1) + n_1*np.log(error_rate) + np.log(1-error_rate**n_2) + n_2*np.log(error_rate))
-          for n_1 in range(1, n) for n_2 in range(1, n-n_1+1)
-        ])
-        for n in N if n<well_size_cutoff
-      ]
-      null_P_a2b = [
-        sum([
-          scipy.misc.comb(n, k) * f_r**k * (1-f_q-f_r)**(n-k) * (1-error_rate**k)**2
-          for k in range(1, n+1)
-        ]) +
-        sum([
-          np.exp(log_fact(n) - log_fact(n_1) - log_fact(n_2) - log_fact(n-n_1-n_2) + n_1*np.log(f_r) + n_2*np.log(f_q) + (n-n_1-n_2)*np.log(1-f_q-f_r) + 2*np.log(1-error_rate**n_2) + n_1*np.log(error_rate))
-          for n_2 in range(1, n) for n_1 in range(1, n-n_2+1)
-        ]) +
-        sum([
-          np.exp(log_fact(n) - log_fact(n_1) - log_fact(n_2) - log_fact(n-n_1-n_2) + n_1*np.log(f_r) + n_2*np.log(f_q) + (n-n_1-n_2)*np.log(1-f_q-f_r) + np.log(1-error_rate**n_1) + n_1*np.log(error_rate) + np.log(1-error_rate**n_2) + n_2*np.log(error_rate))
-          for n_2 in range(1, n) for n_1 in range(1, n-n_2+1)
-        ])
-        for n in N if n<well_size_cutoff
-      ]
-      null_P_a1a2 = [
-        sum([
-          np.exp(log_fact(n) - log_fact(n_1) - log_fact(n_2) - log_fact(n-n_1-n_2) + n_1*np.log(f_q) + n_2*np.log(f_r) + (n-n_1-n_2)*np.log(1-f_q-f_r) + n_1*np.log(error_rate) + np.log(1-error_rate**n_1) + n_2*np.log(error_rate) + np.log(1-error_rate**n_2))
-          for n_1 in range(1,n) for n_2 in range(1, n-n_1+1)
-        ])
-        for n in N if n<well_size_cutoff
-      ]
-      null_P_a1a2b = [
-        sum([
-          np.exp(log_fact(n) - log_fact(n_1) - log_fact(n_2) - log_fact(n-n_1-n_2)) * f_q**n_1 * f_r**n_2 * (1-f_q-f_r)**(n-n_1-n_2) * (
-            error_rate**n_1*(1-error_rate**n_1)*(1-error_rate**n_2)**2 +
-            (1-error_rate**n_1)**2*(1-error_rate**n_2)**2 +
-            (1-error_rate**n_1)**2*error_rate**n_2*(1-error_rate**n_2)
-          )
-          for n_1 in range(1,n) for n_2 in range(1, n-n_1+1)
-        ])
-        for n in N if n<well_size_cutoff
-      ]
-      null_P_other = [1-p1-p2-p3-pd for p1,p2,p3,pd in zip(null_P_a1b, null_P_a2b, null_P_a1a2, null_P_a1a2b)]
-        
-      null_log_likelihood = sum([
-        log_fact(w) - log_fact(k1) - log_fact(k2) - log_fact(k3) - log_fact(kd) - log_fact(ko) + k1*np.log(p1) + k2*np.log(p2) + k3*np.log(p3) + kd*np.log(pd) + ko*np.log(po)
-        for w,k1,k2,k3,kd,ko,p1,p2,p3,pd,po in zip(W, K_1, K_2, K_3, K_d, K_o, null_P_a1b, null_P_a2b, null_P_a1a2, null_P_a1a2b, null_P_other)
-      ])
+    cells_per_well, N, W = extract_cells_per_well(seq_data)
 
-      # Alternative hypothesis (dual clone a1a2b)
-      alt_P_2 = [
-        sum([
-          scipy.misc.comb(n, k) * f_d**k * (1-f_d)**(n-k) * error_rate**k * (1-error_rate**k)**2
-          for k in range(1, n+1)
-        ])
-        for n in N if n<well_size_cutoff
-      ]
-      alt_P_3 = [
-        sum([
-          scipy.misc.comb(n,k) * f_d**k * (1-f_d)**(n-k) * (1-error_rate**k)**3
-          for k in range(1, n+1)
-        ])
-        for n in N if n<well_size_cutoff
-      ]
-      alt_P_other = [1 - 3*p1 - p2 for p1,p2 in zip(alt_P_2, alt_P_3)]
-
-      alt_log_likelihood = sum([
-        log_fact(w) - log_fact(k1) - log_fact(k2) - log_fact(k3) - log_fact(kd) - log_fact(ko) + (k1+k2+k3)*np.log(p1) + kd*np.log(p2) + ko*np.log(po)
-        for w,k1,k2,k3,kd,ko,p1,p2,po in zip(W, K_1, K_2, K_3, K_d, K_o, alt_P_2, alt_P_3, alt_P_other)
-      ])
+    # Cells a1b, a2b, a1a2 (no beta), a1a2b for each candidate
+    cells_temp = [c for alist, blist in candidate_duals for c in [((alist[0],), blist), ((alist[1],), blist), (alist, ()), (alist, blist)]]
+    K = np.array(extract_cell_counts(seq_data, cells_temp, cells_per_well, N, W)).reshape(len(candidate_duals), 4, len(N))
 
-      if alt_log_likelihood - null_log_likelihood >= 10:
-        duals.append(cells_temp[3])
+    sizes = [j for j,n in enumerate(N) if well_size_cutoff is None or n < well_size_cutoff]
+    f_q = [freqs_dict[((alist[0],), blist)] for alist, blist in candidate_duals]
+    f_r = [freqs_dict[((alist[1],), blist)] for alist, blist in candidate_duals]
+    f_d = [freqs_dict[(alist, blist)] for alist, blist in candidate_duals]
+    ratios = dual_log_likelihood_ratios([N[j] for j in sizes], [W[j] for j in sizes], K[:,:,sizes], f_q, f_r, f_d, error_rate=error_rate)
 
-    return duals
+    return [c for c,r in zip(candidate_duals, ratios) if r >= threshold]
 
   def find_duals_clustering(candidate_duals, freqs_dict):
     if len(candidate_duals) < 2:
@@ -313,22 +658,23 @@ def pairs_to_cells(seq_data, pairs):
   freqs_dict = {c: f for c,f in zip(candidate_non_duals+candidate_duals, freqs_list)}
   freqs_CI_dict = {c: f for c,f in zip(candidate_non_duals+candidate_duals, freqs_CI_list)}
   
-#  # Find duals using likelihood method, which is computationally infeasible with wells with >50 cells
-#  likelihood_duals = find_duals_likelihood(candidate_duals, freqs_dict)
-#  #print "Likelihood duals", likelihood_duals
-#
-#  # Find duals using clustering method, which works better lower-frequency cells
-#  clustering_duals = find_duals_clustering(candidate_duals, freqs_dict)
-#  #print "Clustering duals", clustering_duals
-#
-#  # Remove non-dual counterparts for each dual cell found and add in corresponding dual cell
-#  duals = list(set(likelihood_duals + clustering_duals))
-#  for alist,blist in duals:
-#    if ((alist[0],), blist) in cells:
-#      cells.remove(((alist[0],), blist))
-#    if ((alist[1],), blist) in cells:
-#      cells.remove(((alist[1],), blist))
-#    cells.append((alist, blist))
+  if find_duals:
+    # Find duals using likelihood method
+    likelihood_duals = find_duals_likelihood(candidate_duals, freqs_dict)
+    #print "Likelihood duals", likelihood_duals
+
+    # Find duals using clustering method, which works better lower-frequency cells
+    clustering_duals = find_duals_clustering(candidate_duals, freqs_dict)
+    #print "Clustering duals", clustering_duals
+
+    # Remove non-dual counterparts for each dual cell found and add in corresponding dual cell
+    duals = list(set(likelihood_duals + clustering_duals))
+    for alist,blist in duals:
+      if ((alist[0],), blist) in cells:
+        cells.remove(((alist[0],), blist))
+      if ((alist[1],), blist) in cells:
+        cells.remove(((alist[1],), blist))
+      cells.append((alist, blist))
   
   cell_freqs = [freqs_dict[c] for c in cells]
   cell_freqs_CI = [freqs_CI_dict[c] for c in cells]
@@ -357,16 +703,21 @@ def extract_cells_per_well(seq_data):
   N,W = zip(*sorted(N_dict.iteritems()))
   return cells_per_well, N, W
 
-def extract_cell_counts(seq_data, cells, cells_per_well, N, W):
-  K = [[0]*len(N) for i in range(len(cells))]
+# Number of set bits in each possible byte
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
 
-  for well_size, well_data in zip(cells_per_well, seq_data.well_data):
-    well_alphas = set(well_data[0])
-    well_betas = set(well_data[1])
-    N_idx = N.index(well_size)
-    for i,(alist,blist) in enumerate(cells):
-      if all([a in well_alphas for a in alist]) and all([b in well_betas for b in blist]):
-        K[i][N_idx] += 1
+def extract_cell_counts(seq_data, cells, cells_per_well, N, W, chunk_size = 4096):
+  # K[i][j] = number of wells of size N[j] that contain every chain of cells[i]
+  # Each cell's wells are the AND of its chains' well bitsets (see WellOccupancy.cell_bitsets()),
+  # and K is a popcount of those bitsets restricted to the wells of each size
+  occupancy = seq_data.get_occupancy()
+  cells_per_well = np.asarray(cells_per_well)
+  size_masks = [occupancy.pack_wells(cells_per_well == n) for n in N]
 
-  return K
+  K = np.zeros((len(cells), len(N)), dtype=np.int64)
+  for start in range(0, len(cells), chunk_size):
+    bits = occupancy.cell_bitsets(cells[start:start+chunk_size])
+    for j,mask in enumerate(size_masks):
+      K[start:start+chunk_size, j] = _POPCOUNT[bits & mask].sum(axis=1)
 
+  return K.tolist()
@@ -0,0 +1,67 @@
+import sys
+import time
+import multiprocessing
+
+import numpy as np
+
+import solver_Lee
+from seq_generator import SequencingGenerator as SG
+
+## Benchmarks the per-well assignment stage of solver_Lee.solve()
+## Usage: python solver_Lee_benchmark.py [num_wells] [cells_per_well] [iters] [n_jobs]
+
+def time_call(func, *args):
+  start = time.time()
+  res = func(*args)
+  return res, time.time()-start
+
+def run_benchmark(num_wells = 480, cells_per_well = 50, iters = 5, n_jobs = 1):
+  gen = SG(chain_deletion_prob = 0.15, num_wells = num_wells)
+  gen.set_cells_per_well('constant', cells_per_well = cells_per_well)
+  gen.cells = SG.generate_cells(2100)
+  data = gen.generate_data()
+
+  occupancy = data.get_occupancy()
+  well_data = [[occupancy.well_alpha_idx(w).tolist(), occupancy.well_beta_idx(w).tolist()] for w in range(occupancy.num_wells)]
+  well_weights = solver_Lee.association_weights(occupancy)
+  all_scores = occupancy.cooccurrence(well_weights=well_weights)
+
+  pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 else None
+
+  print "Per-well assignment benchmark: {0} wells, {1} cells/well, {2} iterations, {3} job(s)".format(num_wells, cells_per_well, iters, n_jobs)
+
+  t_score, t_single, t_batch, t_solve_single, t_solve_batch, num_problems = 0., 0., 0., 0., 0., 0
+  rand = np.random.RandomState(0)
+  for iter in range(iters):
+    wells_idx = rand.choice(len(well_data), int(0.75*len(well_data)), replace=False)
+    S, t = time_call(solver_Lee.association_scores, occupancy, wells_idx, well_weights, all_scores)
+    lookup = solver_Lee.score_lookup(S)
+    t_score += t
+
+    # One lookup and one solver call per well (as in compute_well_pairings)
+    _, t = time_call(lambda: [solver_Lee.score_submatrix(lookup, *well_data[w]) for w in wells_idx])
+    t_single += t
+    _, t = time_call(lambda: [solver_Lee.compute_well_pairings(well_data[w][0], well_data[w][1], lookup) for w in wells_idx])
+    t_solve_single += t
+
+    # Batched gather and batched solve
+    blocks, t = time_call(solver_Lee.well_score_blocks, lookup, occupancy, wells_idx)
+    t_batch += t
+    _, t = time_call(solver_Lee.solve_well_assignments, blocks, pool)
+    t_solve_batch += t
+
+    num_problems += len(wells_idx)
+
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+  print "  Association scores per iteration: {0:.2f} ms".format(1000*t_score/iters)
+  print "  Submatrix gather per well (one at a time): {0:.1f} us".format(1e6*t_single/num_problems)
+  print "  Submatrix gather per well (batched): {0:.1f} us".format(1e6*t_batch/num_problems)
+  print "  Gather + solve per well (one at a time): {0:.1f} us".format(1e6*t_solve_single/num_problems)
+  print "  Solve per well (batched): {0:.1f} us".format(1e6*t_solve_batch/num_problems)
+
+if __name__ == '__main__':
+  args = [int(v) for v in sys.argv[1:]]
+  run_benchmark(*args)